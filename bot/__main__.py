@@ -1,4 +1,5 @@
 import os
+from urllib.parse import urlsplit
 
 from telegram.ext import (
     Application,
@@ -23,6 +24,14 @@ logging.basicConfig(
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 MONGODB_URL = os.getenv("MONGODB_URL")
+# telegram hands getUpdates to a single consumer per token and answers any
+# other with 409 Conflict, so only one process may poll; to run several behind
+# a load balancer set WEBHOOK_URL to the public address they are reached at
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# echoed by telegram in every request so forged updates can be rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 
 async def app_post_init(application: Application) -> None:
@@ -46,10 +55,32 @@ if __name__ == "__main__":
 
     application.add_handler(CommandHandler("start", handlers.start))
     application.add_handler(CommandHandler("list", handlers.list))
+    application.add_handler(CommandHandler("export", handlers.export))
     application.add_handler(CallbackQueryHandler(handlers.button))
     application.add_handler(
         MessageHandler(filters.TEXT | filters.LOCATION, handlers.location)
     )
     application.add_handler(MessageHandler(filters.PHOTO, handlers.photo))
 
-    application.run_polling()
+    application.job_queue.run_repeating(
+        handlers.sweep_albums,
+        interval=handlers.ALBUM_SWEEP_INTERVAL,
+        first=handlers.ALBUM_SWEEP_INTERVAL,
+    )
+    if handlers.PLANT_ID_ASYNC:
+        application.job_queue.run_repeating(
+            handlers.poll_identifications,
+            interval=handlers.POLL_INTERVAL,
+            first=handlers.POLL_INTERVAL,
+        )
+
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlsplit(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()
@@ -0,0 +1,246 @@
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import os
+import re
+import json
+import time
+import asyncio
+import hmac
+import hashlib
+import ipaddress
+import logging
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+import h11
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from . import db
+
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8080"))
+# shared secret the portal sends as "Authorization: Bearer <token>", only
+# optional while the service listens on loopback
+API_TOKEN = os.getenv("API_TOKEN")
+MONGODB_URL = os.getenv("MONGODB_URL")
+
+CACHE_TTL = 10
+CACHE_SIZE = 1024
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+LIST_PROJECTION = {
+    "_id": False,
+    "namespace": True,
+    "access_token": True,
+    "status": True,
+    "created": True,
+    "completed": True,
+    "reference.message": True,
+    "result.is_plant": True,
+    "result.classification.suggestions.id": True,
+    "result.classification.suggestions.name": True,
+    "result.classification.suggestions.probability": True,
+    "result.classification.suggestions.approved": True,
+}
+
+ROUTE = re.compile(
+    r"^/users/(?P<namespace>[\w.-]+)/(?P<id>-?\d+)/(?P<resource>identifications|stats)$"
+)
+
+Response = Tuple[int, List[Tuple[bytes, bytes]], bytes]
+
+
+class Cache:
+    """Short-lived response cache shared by all connections.
+
+    Entries hold the future of the query, so concurrent requests for the same
+    key wait for one mongo read instead of each starting their own.
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, size: int = CACHE_SIZE) -> None:
+        self.ttl = ttl
+        self.size = size
+        self._entries: OrderedDict[str, Tuple[float, asyncio.Future]] = OrderedDict()
+
+    async def get(
+        self, key: str, load: Callable[[], Awaitable[Tuple[bytes, bytes]]]
+    ) -> Tuple[bytes, bytes]:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            entry = (now + self.ttl, asyncio.ensure_future(load()))
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        try:
+            return await asyncio.shield(entry[1])
+        except Exception:
+            # never cache failures
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+            raise
+
+
+def _json(value: Any) -> Tuple[bytes, bytes]:
+    body = json.dumps(value, default=str, ensure_ascii=False).encode("utf-8")
+    return (body, b'"' + hashlib.sha1(body).hexdigest().encode("ascii") + b'"')
+
+
+def _error(status: int, message: str) -> Response:
+    (body, _) = _json({"error": message})
+    return (status, [(b"content-type", b"application/json")], body)
+
+
+def _int(query: Dict[str, List[str]], name: str, default: int) -> int:
+    try:
+        return int(query[name][0]) if name in query else default
+    except ValueError:
+        raise ValueError(f"'{name}' must be an integer")
+
+
+async def handle_request(
+    client: AsyncIOMotorClient,
+    cache: Cache,
+    method: bytes,
+    target: bytes,
+    headers: Dict[bytes, bytes],
+) -> Response:
+    if method not in (b"GET", b"HEAD"):
+        return _error(405, "method not allowed")
+    if API_TOKEN and not hmac.compare_digest(
+        headers.get(b"authorization", b""), f"Bearer {API_TOKEN}".encode()
+    ):
+        return _error(401, "unauthorized")
+
+    url = urlsplit(target.decode("ascii", errors="replace"))
+    match = ROUTE.match(url.path)
+    if not match:
+        return _error(404, "not found")
+    user = {"namespace": match["namespace"], "id": int(match["id"])}
+
+    if match["resource"] == "stats":
+        key = f"stats:{user['namespace']}:{user['id']}"
+
+        async def load() -> Tuple[bytes, bytes]:
+            return _json(await db.get_user_stats(client, user=user))
+
+    else:
+        query = parse_qs(url.query)
+        try:
+            page = max(_int(query, "page", 1), 1)
+            size = min(max(_int(query, "size", PAGE_SIZE), 1), MAX_PAGE_SIZE)
+        except ValueError as e:
+            return _error(400, str(e))
+        key = f"list:{user['namespace']}:{user['id']}:{page}:{size}"
+
+        async def load() -> Tuple[bytes, bytes]:
+            # one extra document tells whether there is a next page
+            items = await db.list_identifications(
+                client,
+                user=user,
+                projection=LIST_PROJECTION,
+                skip=(page - 1) * size,
+                limit=size + 1,
+            )
+            return _json(
+                {
+                    "page": page,
+                    "size": size,
+                    "next": len(items) > size,
+                    "items": items[:size],
+                }
+            )
+
+    (body, etag) = await cache.get(key, load)
+    response_headers = [
+        (b"etag", etag),
+        (b"cache-control", f"private, max-age={int(cache.ttl)}".encode()),
+    ]
+    if etag in [tag.strip() for tag in headers.get(b"if-none-match", b"").split(b",")]:
+        return (304, response_headers, b"")
+    return (200, [(b"content-type", b"application/json"), *response_headers], body)
+
+
+async def serve_connection(
+    client: AsyncIOMotorClient,
+    cache: Cache,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    conn = h11.Connection(h11.SERVER)
+    request = None
+    try:
+        while True:
+            event = conn.next_event()
+            if event is h11.NEED_DATA:
+                conn.receive_data(await reader.read(64 * 1024))
+            elif isinstance(event, h11.Request):
+                request = event
+            elif isinstance(event, h11.EndOfMessage):
+                try:
+                    (status, headers, body) = await handle_request(
+                        client,
+                        cache,
+                        request.method,
+                        request.target,
+                        {name.lower(): value for (name, value) in request.headers},
+                    )
+                except Exception:
+                    logging.exception("API request failed")
+                    (status, headers, body) = _error(500, "internal error")
+                if status != 304:
+                    headers.append((b"content-length", str(len(body)).encode()))
+                writer.write(
+                    conn.send(h11.Response(status_code=status, headers=headers))
+                )
+                if body and request.method != b"HEAD":
+                    writer.write(conn.send(h11.Data(data=body)))
+                writer.write(conn.send(h11.EndOfMessage()))
+                await writer.drain()
+                if conn.our_state is not h11.DONE or conn.their_state is not h11.DONE:
+                    break
+                conn.start_next_cycle()
+            elif isinstance(event, h11.ConnectionClosed):
+                break
+    except (h11.RemoteProtocolError, ConnectionError) as e:
+        logging.debug(f"API connection dropped: {e}")
+    finally:
+        writer.close()
+
+
+def check_token(host: str, token: str | None) -> None:
+    if token:
+        return
+    try:
+        loopback = host == "localhost" or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise RuntimeError(f"API_TOKEN is required to listen on {host}")
+
+
+async def main() -> None:
+    check_token(API_HOST, API_TOKEN)
+    client = AsyncIOMotorClient(MONGODB_URL)
+    cache = Cache()
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(client, cache, reader, writer),
+        host=API_HOST,
+        port=API_PORT,
+    )
+    logging.info(f"Serving portal API on {API_HOST}:{API_PORT}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    asyncio.run(main())
@@ -1,74 +1,27 @@
-from typing import Any, Dict, List
-from datetime import datetime, timezone
-from pymongo import IndexModel, ReturnDocument, ASCENDING, DESCENDING
+from typing import Any, AsyncIterator, Dict, List
+from datetime import datetime, timedelta, timezone
+from pymongo import ReturnDocument, ReplaceOne, ASCENDING
 
 from motor.motor_asyncio import AsyncIOMotorClient
 
+import logging
 
-async def init(client: AsyncIOMotorClient) -> None:
-    db = client.get_default_database()
-    collection_names = await db.list_collection_names()
+from . import migrations
 
-    if "identifications" not in collection_names:
-        await db.create_collection("identifications")
 
-    await db.identifications.create_indexes(
-        [
-            IndexModel(
-                [("namespace", ASCENDING), ("access_token", ASCENDING)], unique=True
-            ),
-            # IndexModel([("user_id", ASCENDING)]),
-            # IndexModel(
-            #     [("reference.message_id", ASCENDING)],
-            #     partialFilterExpression={"reference.message_id": {"$exists": True}},
-            # ),
-            IndexModel(
-                [("reference.user.id", ASCENDING)],
-                partialFilterExpression={"reference.user": {"$exists": True}},
-            ),
-            IndexModel(
-                [("reference.user.namespace", ASCENDING)],
-                partialFilterExpression={"reference.user": {"$exists": True}},
-            ),
-            IndexModel(
-                [("reference.message.id", ASCENDING)],
-                partialFilterExpression={"reference.message": {"$exists": True}},
-            ),
-            IndexModel(
-                [("reference.message.namespace", ASCENDING)],
-                partialFilterExpression={"reference.message": {"$exists": True}},
-            ),
-            IndexModel([("completed", ASCENDING)]),
-            IndexModel([("created", ASCENDING)]),
-            IndexModel([("status", ASCENDING)]),
-            IndexModel(
-                [
-                    (
-                        "result.classification.suggestions.details.entity_id",
-                        ASCENDING,
-                    )
-                ]
-            ),
-            IndexModel(
-                [("result.classification.suggestions.details.language", ASCENDING)]
-            ),
-            IndexModel([("result.classification.suggestions.id", ASCENDING)]),
-            IndexModel([("result.classification.suggestions.name", ASCENDING)]),
-            IndexModel([("result.classification.suggestions.probability", ASCENDING)]),
-            IndexModel([("result.is_plant.probability", ASCENDING)]),
-        ]
-    )
-
-    if "users" not in collection_names:
-        await db.create_collection("users")
-
-    await db.users.create_indexes(
-        [
-            IndexModel([("namespace", ASCENDING), ("id", ASCENDING)], unique=True),
-            IndexModel([("created_at", DESCENDING)]),
-            IndexModel([("updated_at", DESCENDING)]),
-        ]
-    )
+async def init(client: AsyncIOMotorClient) -> None:
+    # a single read when the schema is current; run `python -m bot.migrations`
+    # as a deploy step so that bot processes never have to build indexes
+    version = await migrations.get_version(client)
+    if version < migrations.SCHEMA_VERSION:
+        logging.warning(
+            f"Schema version {version} is behind {migrations.SCHEMA_VERSION}, migrating"
+        )
+        await migrations.migrate(client)
+    elif version > migrations.SCHEMA_VERSION:
+        logging.warning(
+            f"Schema version {version} is ahead of {migrations.SCHEMA_VERSION}"
+        )
 
 
 async def upsert_user(client: AsyncIOMotorClient, user: dict) -> None:
@@ -110,65 +63,458 @@ async def add_identification(
             )
 
 
+# the order identifications are listed and exported in, kept stable by the token
+SORT = {"created": ASCENDING, "access_token": ASCENDING}
+
+
+def _user_identifications(
+    user: dict,
+    projection: dict | None,
+    filter: dict | None = None,
+    skip: int = 0,
+    limit: int = 0,
+) -> List[dict]:
+    # archived documents are read transparently together with the live ones;
+    # each side is projected before the union so only slim documents are
+    # sorted, the sort keys are kept for that and dropped at the end when
+    # they were not asked for
+    projection = dict(projection) if projection else {"_id": False}
+    inclusion = any(value for key, value in projection.items() if key != "_id")
+    helpers = []
+    for key in SORT:
+        if inclusion and not projection.get(key):
+            projection[key] = True
+            helpers.append(key)
+        elif not inclusion and key in projection:
+            del projection[key]
+            helpers.append(key)
+    branch = [
+        {
+            "$match": {
+                "reference.user.id": user["id"],
+                "reference.user.namespace": user["namespace"],
+                **(filter if filter else {}),
+            }
+        },
+        {"$project": projection},
+    ]
+    pipeline = [
+        *branch,
+        {"$unionWith": {"coll": migrations.ARCHIVE_COLLECTION, "pipeline": branch}},
+        {"$sort": SORT},
+    ]
+    if skip:
+        pipeline.append({"$skip": skip})
+    if limit:
+        pipeline.append({"$limit": limit})
+    if helpers:
+        pipeline.append({"$unset": helpers})
+    return pipeline
+
+
 async def list_identifications(
-    client: AsyncIOMotorClient, user: dict
+    client: AsyncIOMotorClient,
+    user: dict,
+    projection: dict | None = None,
+    skip: int = 0,
+    limit: int = 0,
+    filter: dict | None = None,
 ) -> List[Dict[str, Any]] | None:
     return [
         doc
-        async for doc in client.get_default_database()
-        .identifications.find(
-            filter={
-                "reference.user.id": user["id"],
-                "reference.user.namespace": user["namespace"],
-            },
-            projection={"_id": False},
+        async for doc in client.get_default_database().identifications.aggregate(
+            _user_identifications(user, projection, filter, skip=skip, limit=limit)
         )
-        .sort("created", ASCENDING)
     ]
 
 
-async def get_identification(
-    client: AsyncIOMotorClient, user: dict, id: dict
-) -> List[Dict[str, Any]] | None:
-    identification = await client.get_default_database().identifications.find_one(
-        filter={
+async def get_user_stats(client: AsyncIOMotorClient, user: dict) -> Dict[str, Any]:
+    is_plant = {
+        "$and": [
+            {"$ne": [{"$type": "$result.is_plant.probability"}, "missing"]},
+            {"$gte": ["$result.is_plant.probability", "$result.is_plant.threshold"]},
+        ]
+    }
+    is_approved = {
+        "$anyElementTrue": {
+            "$map": {
+                "input": {"$ifNull": ["$result.classification.suggestions", []]},
+                "in": {"$ne": [{"$type": "$$this.approved"}, "missing"]},
+            }
+        }
+    }
+    match = {
+        "$match": {
             "reference.user.id": user["id"],
             "reference.user.namespace": user["namespace"],
-            "access_token": id["access_token"],
-            "namespace": id["namespace"],
-        },
-        projection={"_id": False},
+        }
+    }
+    cursor = client.get_default_database().identifications.aggregate(
+        [
+            match,
+            {
+                "$unionWith": {
+                    "coll": migrations.ARCHIVE_COLLECTION,
+                    "pipeline": [match],
+                }
+            },
+            {
+                "$group": {
+                    "_id": None,
+                    "identifications": {"$sum": 1},
+                    "plants": {"$sum": {"$cond": [is_plant, 1, 0]}},
+                    "approved": {"$sum": {"$cond": [is_approved, 1, 0]}},
+                    "first": {"$min": "$created"},
+                    "last": {"$max": "$created"},
+                }
+            },
+            {"$project": {"_id": False}},
+        ]
     )
-    return identification if identification else None
+    async for stats in cursor:
+        return stats
+    return {
+        "identifications": 0,
+        "plants": 0,
+        "approved": 0,
+        "first": None,
+        "last": None,
+    }
+
+
+async def iter_identifications(
+    client: AsyncIOMotorClient,
+    user: dict,
+    projection: dict | None = None,
+    batch_size: int = 100,
+) -> AsyncIterator[Dict[str, Any]]:
+    # unlike list_identifications this keeps at most one batch in memory
+    # the whole history is sorted, which may exceed the in-memory limit of
+    # servers before 6.0
+    async for doc in client.get_default_database().identifications.aggregate(
+        _user_identifications(user, projection),
+        batchSize=batch_size,
+        allowDiskUse=True,
+    ):
+        yield doc
+
+
+async def get_identification(
+    client: AsyncIOMotorClient, user: dict, id: dict
+) -> List[Dict[str, Any]] | None:
+    db = client.get_default_database()
+    for collection in (db.identifications, db[migrations.ARCHIVE_COLLECTION]):
+        identification = await collection.find_one(
+            filter={
+                "reference.user.id": user["id"],
+                "reference.user.namespace": user["namespace"],
+                "access_token": id["access_token"],
+                "namespace": id["namespace"],
+            },
+            projection={"_id": False},
+        )
+        if identification:
+            return identification
+    return None
 
 
 async def approve_identification(
     client: AsyncIOMotorClient, user: dict, id: dict, approval: dict
 ) -> None:
     # TODO approval history
+    db = client.get_default_database()
     async with await client.start_session() as session:
         async with session.start_transaction():
-            identification = await client.get_default_database().identifications.find_one_and_update(
-                filter={
-                    "reference.user.id": user["id"],
-                    "reference.user.namespace": user["namespace"],
-                    "access_token": id["access_token"],
-                    "namespace": id["namespace"],
-                },
-                update={
-                    "$set": {
-                        "result.classification.suggestions.$[approved].approved": {
-                            "updated_at": datetime.now().astimezone(timezone.utc)
-                        }
+            for collection in (db.identifications, db[migrations.ARCHIVE_COLLECTION]):
+                identification = await collection.find_one_and_update(
+                    filter={
+                        "reference.user.id": user["id"],
+                        "reference.user.namespace": user["namespace"],
+                        "access_token": id["access_token"],
+                        "namespace": id["namespace"],
                     },
-                    "$unset": {
-                        "result.classification.suggestions.$[unapproved].approved": ""
+                    update={
+                        "$set": {
+                            "result.classification.suggestions.$[approved].approved": {
+                                "updated_at": datetime.now().astimezone(timezone.utc)
+                            }
+                        },
+                        "$unset": {
+                            "result.classification.suggestions.$[unapproved].approved": ""
+                        },
                     },
-                },
-                array_filters=[
-                    {"approved.id": approval["id"]},
-                    {"unapproved.id": {"$ne": approval["id"]}},
-                ],
-                return_document=ReturnDocument.AFTER,
-            )
-            return identification if identification else None
+                    array_filters=[
+                        {"approved.id": approval["id"]},
+                        {"unapproved.id": {"$ne": approval["id"]}},
+                    ],
+                    return_document=ReturnDocument.AFTER,
+                )
+                if identification:
+                    return identification
+            return None
+
+
+async def set_chat_location(
+    client: AsyncIOMotorClient, chat: dict, location: dict | None
+) -> None:
+    await client.get_default_database().chats.update_one(
+        {"namespace": chat["namespace"], "id": chat["id"]},
+        {
+            "$set": {
+                "location": location,
+                "updated_at": datetime.now().astimezone(timezone.utc),
+            }
+        },
+        upsert=True,
+    )
+
+
+async def get_chat_location(client: AsyncIOMotorClient, chat: dict) -> dict | None:
+    doc = await client.get_default_database().chats.find_one(
+        filter={"namespace": chat["namespace"], "id": chat["id"]},
+        projection={"_id": False, "location": True},
+    )
+    return doc.get("location") if doc else None
+
+
+async def add_album_photo(
+    client: AsyncIOMotorClient,
+    album: dict,
+    message_id: int,
+    photo: dict,
+    delay: float,
+) -> None:
+    """Append a photo to a shared album and push its due time ``delay`` forward.
+
+    Any bot process may receive any part of an album; all of them land in the
+    same document, keyed by namespace and media group id.
+    """
+    now = datetime.now().astimezone(timezone.utc)
+    await client.get_default_database().albums.update_one(
+        {"namespace": album["namespace"], "id": album["id"]},
+        {
+            "$setOnInsert": {"created": now, **album},
+            "$min": {"message_id": message_id},
+            "$push": {"photos": photo},
+            "$set": {"due": now + timedelta(seconds=delay)},
+        },
+        upsert=True,
+    )
+
+
+async def claim_album(
+    client: AsyncIOMotorClient,
+    album: dict | None,
+    owner: str,
+    lease: float,
+    attempts: int,
+) -> Dict[str, Any] | None:
+    """Atomically take ownership of an album that is due for identification.
+
+    Without an album the longest overdue one is taken, which is how albums
+    whose job failed or whose owner died are picked up again. Every claim
+    counts as an attempt and albums are given up after ``attempts``.
+
+    Returns the album document, or None if it is not due yet, is gone, or is
+    held by another owner whose lease has not expired.
+    """
+    now = datetime.now().astimezone(timezone.utc)
+    return await client.get_default_database().albums.find_one_and_update(
+        filter={
+            **({"namespace": album["namespace"], "id": album["id"]} if album else {}),
+            "due": {"$lte": now},
+            "photos.0": {"$exists": True},
+            "attempts": {"$not": {"$gte": attempts}},
+            "$or": [{"owner": None}, {"lease_expires": {"$lte": now}}],
+        },
+        update={
+            "$set": {
+                "owner": owner,
+                "lease_expires": now + timedelta(seconds=lease),
+            },
+            "$inc": {"attempts": 1},
+        },
+        projection={"_id": False},
+        sort=[("due", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def release_album(
+    client: AsyncIOMotorClient, album: dict, owner: str, delay: float
+) -> None:
+    # due is pushed forward so a failing album is not retried right away
+    now = datetime.now().astimezone(timezone.utc)
+    await client.get_default_database().albums.update_one(
+        {"namespace": album["namespace"], "id": album["id"], "owner": owner},
+        {
+            "$set": {"due": now + timedelta(seconds=delay)},
+            "$unset": {"owner": "", "lease_expires": ""},
+        },
+    )
+
+
+async def delete_album(
+    client: AsyncIOMotorClient, album: dict, owner: str, count: int
+) -> None:
+    """Drop the first ``count`` photos of a claimed album, the ones processed.
+
+    Photos that arrived after the claim are kept and the album is released,
+    so they are identified on their own once it is due.
+    """
+    albums = client.get_default_database().albums
+    filter = {"namespace": album["namespace"], "id": album["id"], "owner": owner}
+    result = await albums.delete_one({**filter, "photos": {"$size": count}})
+    if result.deleted_count:
+        return
+    # photos are only ever appended, so the processed ones come first
+    await albums.update_one(
+        filter,
+        [
+            {"$set": {"photos": {"$slice": ["$photos", count, {"$size": "$photos"}]}}},
+            {"$unset": ["owner", "lease_expires", "attempts"]},
+        ],
+    )
+
+
+async def claim_pending_identifications(
+    client: AsyncIOMotorClient, owner: str, lease: float, limit: int
+) -> List[Dict[str, Any]]:
+    # the lease keeps concurrent pollers from fetching the same documents
+    # and hands them over if the owner dies; never polled documents come
+    # first, the others in the order they are due again
+    identifications = client.get_default_database().identifications
+    now = datetime.now().astimezone(timezone.utc)
+    claimable = {
+        "namespace": "plant.id",
+        "status": {"$in": ["CREATED", "IN_PROGRESS"]},
+        "$and": [
+            {"$or": [{"poll.owner": None}, {"poll.lease_expires": {"$lte": now}}]},
+            {"$or": [{"poll.next_at": None}, {"poll.next_at": {"$lte": now}}]},
+        ],
+    }
+    claimed = []
+    async for doc in identifications.find(
+        filter=claimable, projection={"_id": False}, limit=limit
+    ).sort([("poll.next_at", ASCENDING), ("created", ASCENDING)]):
+        result = await identifications.update_one(
+            {**claimable, "access_token": doc["access_token"]},
+            {
+                "$set": {
+                    "poll.owner": owner,
+                    "poll.lease_expires": now + timedelta(seconds=lease),
+                }
+            },
+        )
+        if result.modified_count:
+            claimed.append(doc)
+    return claimed
+
+
+async def complete_identification(
+    client: AsyncIOMotorClient, id: dict, identification: dict
+) -> Dict[str, Any] | None:
+    return await client.get_default_database().identifications.find_one_and_update(
+        filter={"namespace": id["namespace"], "access_token": id["access_token"]},
+        update={
+            "$set": {
+                key: value
+                for (key, value) in identification.items()
+                if key not in ("namespace", "access_token", "reference")
+            },
+            "$unset": {"poll": ""},
+        },
+        projection={"_id": False},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def release_identifications(
+    client: AsyncIOMotorClient, access_tokens: List[str], owner: str
+) -> None:
+    now = datetime.now().astimezone(timezone.utc)
+    await client.get_default_database().identifications.update_many(
+        {
+            "namespace": "plant.id",
+            "access_token": {"$in": access_tokens},
+            "poll.owner": owner,
+        },
+        {
+            "$set": {"poll.next_at": now},
+            "$unset": {"poll.owner": "", "poll.lease_expires": ""},
+        },
+    )
+
+
+async def retry_identifications(
+    client: AsyncIOMotorClient,
+    access_tokens: List[str],
+    owner: str,
+    backoff: float,
+    max_backoff: float,
+) -> None:
+    """Release identifications that could not be retrieved.
+
+    Each one counts a failed attempt in ``poll.attempts`` and is not claimed
+    again before ``backoff`` doubled per attempt, at most ``max_backoff``.
+    """
+    now = datetime.now().astimezone(timezone.utc)
+    previous = {"$ifNull": ["$poll.attempts", 0]}
+    delay = {
+        "$min": [
+            {"$multiply": [backoff * 1000, {"$pow": [2, previous]}]},
+            max_backoff * 1000,
+        ]
+    }
+    await client.get_default_database().identifications.update_many(
+        {
+            "namespace": "plant.id",
+            "access_token": {"$in": access_tokens},
+            "poll.owner": owner,
+        },
+        [
+            {
+                "$set": {
+                    "poll.attempts": {"$add": [previous, 1]},
+                    "poll.next_at": {"$add": [now, delay]},
+                }
+            },
+            {"$unset": ["poll.owner", "poll.lease_expires"]},
+        ],
+    )
+
+
+async def archive_identifications(
+    client: AsyncIOMotorClient, before: datetime, limit: int
+) -> int:
+    # each batch moves in one transaction: an update that lands on a live
+    # document after it was read makes the delete conflict, and the whole
+    # move is retried with the updated document
+    db = client.get_default_database()
+
+    async def move(session) -> int:
+        identifications = await db.identifications.find(
+            {
+                "created": {"$lt": before.timestamp()},
+                "status": {"$nin": ["CREATED", "IN_PROGRESS"]},
+            },
+            limit=limit,
+            session=session,
+        ).to_list(length=limit)
+        if not identifications:
+            return 0
+        # replacing also overwrites copies left behind by interrupted moves
+        await db[migrations.ARCHIVE_COLLECTION].bulk_write(
+            [
+                ReplaceOne({"_id": identification["_id"]}, identification, upsert=True)
+                for identification in identifications
+            ],
+            ordered=False,
+            session=session,
+        )
+        ids = [identification["_id"] for identification in identifications]
+        await db.identifications.delete_many({"_id": {"$in": ids}}, session=session)
+        return len(identifications)
+
+    async with await client.start_session() as session:
+        return await session.with_transaction(move)
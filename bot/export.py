@@ -0,0 +1,129 @@
+from typing import IO, Any, Dict, List, Tuple
+
+import os
+import csv
+import gzip
+import json
+import functools
+import asyncio
+import tempfile
+from datetime import datetime, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from . import db
+
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_BATCH_SIZE = 200
+
+# only what ends up in a row is fetched, never images or suggestion details
+EXPORT_PROJECTION = {
+    "_id": False,
+    "namespace": True,
+    "access_token": True,
+    "status": True,
+    "created": True,
+    "completed": True,
+    "input.latitude": True,
+    "input.longitude": True,
+    "result.is_plant.probability": True,
+    "result.classification.suggestions.name": True,
+    "result.classification.suggestions.probability": True,
+    "result.classification.suggestions.approved": True,
+}
+
+EXPORT_FIELDS = [
+    "namespace",
+    "access_token",
+    "status",
+    "created",
+    "completed",
+    "latitude",
+    "longitude",
+    "is_plant",
+    "name",
+    "probability",
+    "approved",
+]
+
+
+def _timestamp(value: Any) -> str | None:
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).isoformat()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_row(identification: Dict[str, Any]) -> Dict[str, Any]:
+    input = identification.get("input") or {}
+    result = identification.get("result") or {}
+    suggestions = (result.get("classification") or {}).get("suggestions") or []
+    top = suggestions[0] if suggestions else {}
+    approved = [s.get("name") for s in suggestions if "approved" in s]
+    return {
+        "namespace": identification.get("namespace"),
+        "access_token": identification.get("access_token"),
+        "status": identification.get("status"),
+        "created": _timestamp(identification.get("created")),
+        "completed": _timestamp(identification.get("completed")),
+        "latitude": input.get("latitude"),
+        "longitude": input.get("longitude"),
+        "is_plant": (result.get("is_plant") or {}).get("probability"),
+        "name": top.get("name"),
+        "probability": top.get("probability"),
+        "approved": approved[0] if approved else None,
+    }
+
+
+def _write_ndjson(out: IO[str], rows: List[Dict[str, Any]]) -> None:
+    out.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+
+async def export_identifications(
+    client: AsyncIOMotorClient,
+    user: dict,
+    format: str = "ndjson",
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> Tuple[str, int]:
+    """Write the user's identifications to a gzipped temp file.
+
+    Returns the file path, which the caller must remove, and the row count.
+    Rows are written one cursor batch at a time off the event loop, so memory
+    use does not depend on the size of the history.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+    with tempfile.NamedTemporaryFile(
+        prefix="identifications-", suffix=f".{format}.gz", delete=False
+    ) as file:
+        path = file.name
+
+    # the caller only learns the path on success, so clean up on failure
+    try:
+        count = 0
+        with gzip.open(path, "wt", encoding="utf-8", newline="") as out:
+            if format == "csv":
+                writer = csv.DictWriter(out, fieldnames=EXPORT_FIELDS)
+                writer.writeheader()
+                write = writer.writerows
+            else:
+                write = functools.partial(_write_ndjson, out)
+            rows: List[Dict[str, Any]] = []
+            async for identification in db.iter_identifications(
+                client, user=user, projection=EXPORT_PROJECTION, batch_size=batch_size
+            ):
+                rows.append(export_row(identification))
+                if len(rows) >= batch_size:
+                    await asyncio.to_thread(write, rows)
+                    count += len(rows)
+                    rows = []
+            if rows:
+                await asyncio.to_thread(write, rows)
+                count += len(rows)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return (path, count)
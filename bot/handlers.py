@@ -1,6 +1,10 @@
-from typing import Tuple, Dict, List, Any
+from typing import Tuple, Dict, List, Any, Callable
 
+import os
+import time
+import socket
 import base64
+from collections import OrderedDict
 
 import logging
 from pprint import pformat
@@ -18,16 +22,71 @@ from telegram import (
 
 from telegram.ext import ContextTypes, CallbackContext
 
-from .identify import create_identification
+from telegram.error import TelegramError
+
+from .identify import PLANT_ID_ASYNC, create_identification, retrieve_identifications
+from .export import EXPORT_FORMATS, export_identifications
 from . import db
+from . import models
 
 GALLERY_TIMEOUT = 1
+# how long an instance may hold an album before another one may take it over
+ALBUM_LEASE = 5 * 60
+ALBUM_ATTEMPTS = 3
+# albums whose job failed or whose owner died are picked up by sweep_albums
+ALBUM_SWEEP_INTERVAL = 60
+
+# async plant.id submissions are collected in batches by poll_identifications
+POLL_INTERVAL = 5
+POLL_LEASE = 60
+POLL_BATCH_SIZE = 10
+# failed retrievals are retried with exponential backoff and given up on after
+# POLL_ATTEMPTS, as is anything still pending after POLL_MAX_AGE
+POLL_ATTEMPTS = 8
+POLL_BACKOFF = POLL_INTERVAL
+POLL_MAX_BACKOFF = 60 * 60
+POLL_MAX_AGE = 24 * 60 * 60
 
 LANGUAGES = ["en", "ru", "ua"]
 
-media_groups: Dict[str, list[Tuple[PhotoSize, ...]]] = {}
-album_message_ids: Dict[str, int] = {}
-chat_locations: Dict[int, Location] = {}
+LIST_PAGE_SIZE = 10
+LIST_PROJECTION = {
+    "_id": False,
+    "namespace": True,
+    "access_token": True,
+    "result.is_plant": True,
+    "result.classification.suggestions.name": True,
+    "result.classification.suggestions.probability": True,
+    "result.classification.suggestions.approved": True,
+}
+LIST_FILTER = {
+    "namespace": "plant.id",
+    "status": "COMPLETED",
+    "$expr": {"$gte": ["$result.is_plant.probability", "$result.is_plant.threshold"]},
+}
+
+# callback data is capped at 64 bytes: namespaces get one letter, the long
+# form is still accepted from messages sent before
+CALLBACK_NAMESPACES = {"p": "plant.id", "plant.id": "plant.id"}
+CALLBACK_LIST = "l"
+
+# rendered texts and keyboards by access token, approval state and view
+RENDER_CACHE_SIZE = 1024
+rendered: OrderedDict[tuple, Any] = OrderedDict()
+
+# albums and chat locations live in mongo so any number of bot processes
+# behind a webhook can share the load; this tags the albums claimed by this
+# process
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def get_location(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int
+) -> Location | None:
+    location = await db.get_chat_location(
+        context.bot_data["db_client"], chat={"namespace": "tg", "id": chat_id}
+    )
+    return Location(**location) if location else None
 
 
 async def identify_photos(
@@ -52,65 +111,178 @@ async def identify_photos(
     id = await create_identification(
         images=images,
         location=(location.latitude, location.longitude) if location else None,
+        asynchronous=PLANT_ID_ASYNC,
     )
 
     logging.debug(f"\nIdentification: {pformat(id, indent=2)}")
 
     if isinstance(id, dict):
-        # TODO:
-        # Pydantic models for User, Message, etc.
-        # move reference to db.add_identification
-        reference = {
-            "user": {"namespace": "tg", "id": user_id},
-            "message": {"namespace": "tg", "id": message_id},
-        }
+        # TODO: move reference to db.add_identification
+        user = models.User("tg", user_id)
+        reference = models.Reference(user, models.Message("tg", message_id))
+        identification = models.Identification(id)
+
+        if identification.pending:
+            # poll_identifications replaces this once plant.id is done
+            reply = await context.bot.send_message(
+                chat_id=chat_id,
+                text="Processing...",
+                reply_to_message_id=message_id,
+            )
+            reference.chat = models.Chat("tg", chat_id)
+            reference.reply = models.Message("tg", reply.message_id)
 
         await db.add_identification(
             client=context.bot_data["db_client"],
-            user={"namespace": "tg", "id": user_id},
+            user=user.to_dict(),
             identification={
-                "reference": reference,
+                "reference": reference.to_dict(),
                 **id,
             },
         )
-        if id["namespace"] == "plant.id":
-            base_suggestion = id["result"]["classification"]["suggestions"][0]
-            text = (
-                f"{round(base_suggestion['probability']*100)}% {base_suggestion['name']}\n"
-                f"see also:"
-            )
-            keyboard = []
-            for lang in ("global", *LANGUAGES):
-                if isinstance(base_suggestion["details"]["url"][lang], str):
-                    keyboard.append(
-                        InlineKeyboardButton(
-                            lang, url=base_suggestion["details"]["url"][lang]
-                        )
-                    )
-            reply_markup = InlineKeyboardMarkup([keyboard])
+        if identification.namespace == "plant.id" and not identification.pending:
+            (text, keyboard) = create_reply(identification)
             await context.bot.send_message(
                 chat_id=chat_id,
                 text=text,
-                reply_markup=reply_markup,
+                reply_markup=InlineKeyboardMarkup(keyboard),
                 reply_to_message_id=message_id,
             )
 
 
-async def batch_group_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    global media_groups, chat_locations, album_message_ids
+def create_reply(
+    identification: models.Identification,
+) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    base_suggestion = identification.suggestion(0)
+    text = f"{base_suggestion.percent}% {base_suggestion.name}\nsee also:"
+    keyboard = []
+    for lang in ("global", *LANGUAGES):
+        if isinstance(base_suggestion.url.get(lang), str):
+            keyboard.append(InlineKeyboardButton(lang, url=base_suggestion.url[lang]))
+    return (text, [keyboard])
+
+
+async def poll_identifications(context: ContextTypes.DEFAULT_TYPE) -> None:
+    client = context.bot_data["db_client"]
+    pending = await db.claim_pending_identifications(
+        client, owner=INSTANCE_ID, lease=POLL_LEASE, limit=POLL_BATCH_SIZE
+    )
+    if not pending:
+        return
+
+    results = await retrieve_identifications([doc["access_token"] for doc in pending])
+    now = time.time()
+    unfinished = []
+    failed = []
+    for doc, result in zip(pending, results):
+        if result is None or models.Identification(result).pending:
+            # only failed retrievals count as attempts
+            attempts = doc.get("poll", {}).get("attempts", 0) + (result is None)
+            age = now - doc.get("created", now)
+            if attempts < POLL_ATTEMPTS and age <= POLL_MAX_AGE:
+                (failed if result is None else unfinished).append(doc["access_token"])
+                continue
+            logging.warning(f"Giving up on identification {doc['access_token']}")
+            result = {
+                "namespace": doc["namespace"],
+                "access_token": doc["access_token"],
+                "status": "FAILED",
+            }
+        identification = await db.complete_identification(
+            client, id=result, identification=result
+        )
+        if identification is None:
+            continue
+        identification = models.Identification(identification)
+        reference = identification.reference
+        if reference.chat is None or reference.reply is None:
+            continue
+        if identification.status == "COMPLETED":
+            (text, keyboard) = create_reply(identification)
+            reply_markup = InlineKeyboardMarkup(keyboard)
+        else:
+            text = "Sorry, the identification failed."
+            reply_markup = None
+        try:
+            await context.bot.edit_message_text(
+                chat_id=reference.chat.id,
+                message_id=reference.reply.id,
+                text=text,
+                reply_markup=reply_markup,
+            )
+        except TelegramError as e:
+            logging.warning(f"Updating reply {reference.reply.id} failed: {e}")
+
+    if unfinished:
+        await db.release_identifications(client, unfinished, owner=INSTANCE_ID)
+    if failed:
+        await db.retry_identifications(
+            client,
+            failed,
+            owner=INSTANCE_ID,
+            backoff=POLL_BACKOFF,
+            max_backoff=POLL_MAX_BACKOFF,
+        )
 
+
+async def identify_album(context: ContextTypes.DEFAULT_TYPE, album: dict) -> None:
+    client = context.bot_data["db_client"]
+    album_id = {"namespace": album["namespace"], "id": album["id"]}
+    try:
+        await identify_photos(
+            context,
+            user_id=album["user_id"],
+            chat_id=album["chat_id"],
+            message_id=album["message_id"],
+            photos=[
+                (PhotoSize.de_json(photo, context.bot),) for photo in album["photos"]
+            ],
+            location=await get_location(context, album["chat_id"]),
+        )
+    except Exception:
+        logging.exception(f"Identifying album {album['id']} failed")
+        if album.get("attempts", 0) < ALBUM_ATTEMPTS:
+            await db.release_album(
+                client, album=album_id, owner=INSTANCE_ID, delay=ALBUM_SWEEP_INTERVAL
+            )
+            return
+        await context.bot.send_message(
+            chat_id=album["chat_id"],
+            text="Sorry, the identification failed.",
+            reply_to_message_id=album["message_id"],
+        )
+
+    await db.delete_album(
+        client, album=album_id, owner=INSTANCE_ID, count=len(album["photos"])
+    )
+
+
+async def batch_group_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.debug(f"Batch job data: {context.job.data}")
-    await identify_photos(
-        context,
-        user_id=context.job.user_id,
-        chat_id=context.job.chat_id,
-        message_id=album_message_ids[context.job.data],
-        photos=media_groups[context.job.data],
-        location=chat_locations.get(context.job.chat_id, None),
+    album = await db.claim_album(
+        context.bot_data["db_client"],
+        album={"namespace": "tg", "id": context.job.data},
+        owner=INSTANCE_ID,
+        lease=ALBUM_LEASE,
+        attempts=ALBUM_ATTEMPTS,
     )
+    if album is None:
+        # still receiving photos or taken by another instance
+        logging.debug(f"Album {context.job.data} not claimed")
+        return
+    await identify_album(context, album)
 
-    media_groups[context.job.data] = None
-    album_message_ids[context.job.data] = None
+
+async def sweep_albums(context: ContextTypes.DEFAULT_TYPE) -> None:
+    while album := await db.claim_album(
+        context.bot_data["db_client"],
+        album=None,
+        owner=INSTANCE_ID,
+        lease=ALBUM_LEASE,
+        attempts=ALBUM_ATTEMPTS,
+    ):
+        logging.info(f"Album {album['id']} picked up by the sweeper")
+        await identify_album(context, album)
 
 
 async def start(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
@@ -136,14 +308,21 @@ async def start(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
-async def location(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
-    global chat_locations
+async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = {"namespace": "tg", "id": update.effective_chat.id}
     if update.message.location:
         # Handle location
         logging.info(
             f"Received location:\n{pformat(update.message.location, indent=2)}"
         )
-        chat_locations[update.effective_chat.id] = update.message.location
+        await db.set_chat_location(
+            context.bot_data["db_client"],
+            chat=chat,
+            location={
+                "latitude": update.message.location.latitude,
+                "longitude": update.message.location.longitude,
+            },
+        )
         # latitude = update.message.location.latitude
         # longitude = update.message.location.longitude
         # await update.message.reply_text(
@@ -151,7 +330,9 @@ async def location(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         # )
     elif update.message.text == "No Location":
         # Handle refusal to send location
-        chat_locations[update.effective_chat.id] = None
+        await db.set_chat_location(
+            context.bot_data["db_client"], chat=chat, location=None
+        )
         await update.message.reply_text(
             "That's okay! However the quality might suffer."
         )
@@ -163,7 +344,6 @@ async def location(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global media_groups
     if update.message.photo:
         logging.debug(f"\nReceived photo:\n{pformat(update.message.photo, indent=2)}\n")
         # logging.info(f"job_queue: {pformat(context.job_queue, indent=2)}")
@@ -172,11 +352,21 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             chat_id = update.effective_chat.id
             message_id = update.message.message_id
             logging.debug(f"Media group: {group_id}")
-            if group_id not in media_groups:
-                media_groups[group_id] = []
-                album_message_ids[group_id] = message_id
-            media_groups[group_id].append(update.message.photo)
-            job_name = f"gal:{chat_id}"
+            await db.add_album_photo(
+                context.bot_data["db_client"],
+                album={
+                    "namespace": "tg",
+                    "id": group_id,
+                    "chat_id": chat_id,
+                    "user_id": update.effective_user.id,
+                },
+                message_id=message_id,
+                photo=update.message.photo[-1].to_dict(),
+                delay=GALLERY_TIMEOUT,
+            )
+            # every instance that got a part of the album schedules its own
+            # job; only the one that fires after the last photo can claim it
+            job_name = f"gal:{group_id}"
             jobs = context.job_queue.get_jobs_by_name(job_name)
             if jobs:
                 for job in jobs:
@@ -197,49 +387,79 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 chat_id=update.message.chat_id,
                 message_id=update.message.id,
                 photos=[update.message.photo],
-                location=chat_locations.get(context.job.chat_id, None),
+                location=await get_location(context, update.message.chat_id),
             )
 
 
+def render(key: tuple, create: Callable[[], Any]) -> Any:
+    if key in rendered:
+        rendered.move_to_end(key)
+        return rendered[key]
+    rendered[key] = create()
+    if len(rendered) > RENDER_CACHE_SIZE:
+        rendered.popitem(last=False)
+    return rendered[key]
+
+
 def create_message(
-    identification: Dict[str, Any], selected=None
+    identification: models.Identification, selected=None, page=None
+) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    return render(
+        (
+            "message",
+            identification.access_token,
+            identification.approval,
+            selected,
+            page,
+        ),
+        lambda: _create_message(identification, selected, page),
+    )
+
+
+def _create_message(
+    identification: models.Identification, selected, page
 ) -> Tuple[str, List[List[InlineKeyboardButton]]]:
     keyboard = []
+    access_token = identification.access_token
+    # keep the list page to return to across the views of one identification
+    suffix = f":{page}" if page is not None else ""
 
     if selected is None:
-        for i, suggestion in enumerate(
-            identification["result"]["classification"]["suggestions"]
-        ):
+        for i, suggestion in enumerate(identification.suggestions):
+            keyboard.append(
+                [
+                    InlineKeyboardButton(
+                        f"{suggestion.percent}% {suggestion.name}"
+                        + (" \u2705" if suggestion.approved else ""),
+                        callback_data=f"p:{access_token}:@{i}{suffix}",
+                    )
+                ]
+            )
+        if page is not None:
             keyboard.append(
                 [
                     InlineKeyboardButton(
-                        f"{round(suggestion['probability']*100)}% {suggestion['name']}"
-                        + (" \u2705" if "approved" in suggestion else ""),
-                        callback_data=f"plant.id:{identification['access_token']}:@{i}",
+                        f"{'Back'}", callback_data=f"{CALLBACK_LIST}:{page}"
                     )
                 ]
             )
-        text = f"{'Plant probability:'} {round(identification['result']['is_plant']['probability']*100)}%"
+        text = (
+            f"{'Plant probability:'} {round(identification.is_plant_probability*100)}%"
+        )
 
     else:
-        suggestion = identification["result"]["classification"]["suggestions"][selected]
-        common_names = []
-        langs = LANGUAGES
-        langs.reverse()
-        for lang in langs:
-            if suggestion["details"]["common_names"][lang]:
-                common_names.extend(suggestion["details"]["common_names"][lang])
+        suggestion = identification.suggestion(selected)
+        common_names = suggestion.common_names(reversed(LANGUAGES))
 
-        text = (
-            f"*{round(suggestion['probability']*100)}% {suggestion['name']}*\n"
-            + "\n".join([f"\u2022 {cname}" for cname in common_names])
+        text = f"*{suggestion.percent}% {suggestion.name}*\n" + "\n".join(
+            [f"\u2022 {cname}" for cname in common_names]
         )
 
         keyboard.append(
             [
                 InlineKeyboardButton(
                     f"{'Approve'}",
-                    callback_data=f"plant.id:{identification['access_token']}:!{selected}",
+                    callback_data=f"p:{access_token}:!{selected}{suffix}",
                 )
             ]
         )
@@ -247,64 +467,155 @@ def create_message(
             [
                 InlineKeyboardButton(
                     f"{'Back'}",
-                    callback_data=f"plant.id:{identification['access_token']}:back",
+                    callback_data=f"p:{access_token}:back{suffix}",
                 )
             ]
         )
     return (text, keyboard)
 
 
-async def list(update: Update, context: CallbackContext) -> None:
+def create_list_line(identification: models.Identification) -> str:
+    approval = identification.approval
+    suggestion = identification.suggestion(approval[0] if approval else 0)
+    return f"{suggestion.percent}% {suggestion.name}" + (" \u2705" if approval else "")
+
+
+def create_list_page(
+    identifications: List[models.Identification], page: int, more: bool
+) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    lines = []
+    buttons = []
+    for n, identification in enumerate(
+        identifications, start=page * LIST_PAGE_SIZE + 1
+    ):
+        line = render(
+            ("line", identification.access_token, identification.approval),
+            lambda: create_list_line(identification),
+        )
+        lines.append(f"{n}. {line}")
+        buttons.append(
+            InlineKeyboardButton(
+                f"{n}", callback_data=f"p:{identification.access_token}:back:{page}"
+            )
+        )
+    keyboard = [buttons[i : i + 5] for i in range(0, len(buttons), 5)]
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton("\u00ab", callback_data=f"{CALLBACK_LIST}:{page-1}")
+        )
+    if more:
+        navigation.append(
+            InlineKeyboardButton("\u00bb", callback_data=f"{CALLBACK_LIST}:{page+1}")
+        )
+    if navigation:
+        keyboard.append(navigation)
+    return ("\n".join(lines), keyboard)
+
+
+async def list_page(
+    context: CallbackContext, user_id: int, page: int
+) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    # one more than a page tells whether there is a next one
     identifications = await db.list_identifications(
         context.bot_data["db_client"],
-        user={"namespace": "tg", "id": update.message.from_user.id},
+        user={"namespace": "tg", "id": user_id},
+        projection=LIST_PROJECTION,
+        skip=page * LIST_PAGE_SIZE,
+        limit=LIST_PAGE_SIZE + 1,
+        filter=LIST_FILTER,
     )
     logging.debug(f"Identifications:\n{pformat(identifications, indent=2)}")
-    for identification in identifications:
-        if identification["namespace"] != "plant.id":
-            continue
-        if (
-            identification["result"]["is_plant"]["probability"]
-            < identification["result"]["is_plant"]["threshold"]
-        ):
-            continue
-        (text, keyboard) = create_message(identification)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            reply_to_message_id=identification["reference"]["message"]["id"],
-            text=text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-        )
+    if not identifications:
+        return ("No identifications yet.", [])
+    return create_list_page(
+        [
+            models.Identification(identification)
+            for identification in identifications[:LIST_PAGE_SIZE]
+        ],
+        page=page,
+        more=len(identifications) > LIST_PAGE_SIZE,
+    )
+
+
+async def list(update: Update, context: CallbackContext) -> None:
+    (text, keyboard) = await list_page(context, update.message.from_user.id, page=0)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
+
+
+async def export(update: Update, context: CallbackContext) -> None:
+    format = context.args[0].lower() if context.args else EXPORT_FORMATS[0]
+    if format not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Usage: /export [{'|'.join(EXPORT_FORMATS)}]")
+        return
+    (path, count) = await export_identifications(
+        context.bot_data["db_client"],
+        user={"namespace": "tg", "id": update.message.from_user.id},
+        format=format,
+    )
+    try:
+        if count == 0:
+            await update.message.reply_text("Nothing to export yet.")
+            return
+        with open(path, "rb") as document:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=document,
+                filename=f"identifications.{format}.gz",
+                caption=f"{count} identifications",
+            )
+    finally:
+        os.remove(path)
 
 
 async def button(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     logging.debug(f"Callback query:\n{pformat(query, indent=2)}")
     await query.answer()
-    (namespace, access_token, action) = query.data.split(":")
+    data = query.data.split(":")
+    if data[0] == CALLBACK_LIST:
+        (text, keyboard) = await list_page(
+            context, update.effective_user.id, page=int(data[1])
+        )
+        await query.edit_message_text(
+            text=text, reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    (namespace, access_token, action, *rest) = data
+    namespace = CALLBACK_NAMESPACES.get(namespace, namespace)
+    page = int(rest[0]) if rest else None
     identification = await db.get_identification(
         context.bot_data["db_client"],
         user={"namespace": "tg", "id": update.effective_user.id},
         id={"namespace": namespace, "access_token": access_token},
     )
     logging.debug(f"Identification:\n{pformat(identification, indent=2)}")
-    if identification["namespace"] != "plant.id":
+    if identification is None:
+        return
+    identification = models.Identification(identification)
+    if identification.namespace != "plant.id":
         return
     if action == "back":
-        (text, keyboard) = create_message(identification)
+        (text, keyboard) = create_message(identification, page=page)
     elif action.startswith("@"):
-        (text, keyboard) = create_message(identification, selected=int(action[1:]))
+        (text, keyboard) = create_message(
+            identification, selected=int(action[1:]), page=page
+        )
     elif action.startswith("!"):
-        suggestion = identification["result"]["classification"]["suggestions"][
-            int(action[1:])
-        ]
+        suggestion = identification.suggestion(int(action[1:]))
         identification = await db.approve_identification(
             context.bot_data["db_client"],
             user={"namespace": "tg", "id": update.effective_user.id},
             id={"namespace": namespace, "access_token": access_token},
-            approval={"id": suggestion["id"]},
+            approval={"id": suggestion.id},
+        )
+        (text, keyboard) = create_message(
+            models.Identification(identification), page=page
         )
-        (text, keyboard) = create_message(identification)
     await query.edit_message_text(
         text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown"
     )
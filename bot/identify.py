@@ -1,51 +1,68 @@
 from typing import Dict, List, Tuple
 
 import os
+import asyncio
 import certifi
 
 import logging
 from pprint import pformat
+from contextlib import asynccontextmanager
 
 from aioplantid_sdk import Configuration, ApiClient, DefaultApi as PlantIdApi
 
 PLANT_ID_API_KEY = os.getenv("PLANT_ID_API_KEY")
+# point at a local stand-in for development and tests
+PLANT_ID_API_URL = os.getenv("PLANT_ID_API_URL", "https://plant.id/api/v3")
+# submit without waiting for classification, results are collected by a poller
+PLANT_ID_ASYNC = os.getenv("PLANT_ID_ASYNC", "").lower() in ("1", "true", "yes")
 
+DETAILS = ",".join(
+    [
+        "common_names",
+        "url",
+        #     "description",
+        #     "taxonomy",
+        #     "rank",
+        #     "gbif_id",
+        #     "inaturalist_id",
+        #     "image",
+        #     "synonyms",
+        #     "edible_parts",
+        #     "watering",
+        #     "propagation_methods",
+    ]
+)
+LANGUAGE = ",".join(["en", "ru", "ua"])
 
-async def create_identification(
-    images: List[bytearray],
-    location: Tuple = None,
-) -> dict | None:
-    (latitude, longitude) = location if location else (None, None)
 
+@asynccontextmanager
+async def plant_id_api():
     async with ApiClient(
         Configuration(
-            host="https://plant.id/api/v3",
+            host=PLANT_ID_API_URL,
             ssl_ca_cert=certifi.where(),
         )
     ) as api_client:
         api_client.set_default_header("Content-Type", "application/json")
         api_client.set_default_header("Api-Key", PLANT_ID_API_KEY)
-        api = PlantIdApi(api_client)
+        yield PlantIdApi(api_client)
+
+
+async def create_identification(
+    images: List[bytearray],
+    location: Tuple = None,
+    asynchronous: bool = False,
+) -> dict | None:
+    (latitude, longitude) = location if location else (None, None)
+
+    async with plant_id_api() as api:
         body = {"images": images, "latitude": latitude, "longitude": longitude}
+        kwargs = {"var_async": True} if asynchronous else {}
         plant_id = await api.create_identification(
-            details=",".join(
-                [
-                    "common_names",
-                    "url",
-                    #     "description",
-                    #     "taxonomy",
-                    #     "rank",
-                    #     "gbif_id",
-                    #     "inaturalist_id",
-                    #     "image",
-                    #     "synonyms",
-                    #     "edible_parts",
-                    #     "watering",
-                    #     "propagation_methods",
-                ]
-            ),
-            language=",".join(["en", "ru", "ua"]),
+            details=DETAILS,
+            language=LANGUAGE,
             body=body,
+            **kwargs,
         )
         logging.info(f"Identification access token: {plant_id['access_token']}")
 
@@ -57,3 +74,29 @@ async def create_identification(
 
         else:
             return None
+
+
+async def retrieve_identifications(access_tokens: List[str]) -> List[dict | None]:
+    # plant.id has no bulk endpoint, so a batch is fetched concurrently
+    # over one client session
+    async with plant_id_api() as api:
+        results = await asyncio.gather(
+            *[
+                api.retrieve_identification(
+                    access_token=access_token, details=DETAILS, language=LANGUAGE
+                )
+                for access_token in access_tokens
+            ],
+            return_exceptions=True,
+        )
+
+    identifications = []
+    for access_token, plant_id in zip(access_tokens, results):
+        if isinstance(plant_id, dict):
+            identifications.append({"namespace": "plant.id", **plant_id})
+        else:
+            logging.warning(
+                f"Retrieving identification {access_token} failed: {pformat(plant_id)}"
+            )
+            identifications.append(None)
+    return identifications
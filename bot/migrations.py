@@ -0,0 +1,214 @@
+from typing import Awaitable, Callable, List
+
+import os
+import sys
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timezone
+from pymongo import IndexModel, ASCENDING, DESCENDING
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+# albums given up on after ALBUM_ATTEMPTS are eventually dropped by mongod
+ALBUM_TTL = 24 * 60 * 60
+
+SCHEMA_ID = "schema"
+
+# identifications moved out of the live collection by bot.retention
+ARCHIVE_COLLECTION = "identifications_archive"
+
+
+async def _create_indexes(collection, indexes: List[IndexModel]) -> None:
+    # servers before 4.2 would otherwise lock the collection for the build,
+    # newer ones build every index this way and ignore the option
+    for index in indexes:
+        index.document.setdefault("background", True)
+    await collection.create_indexes(indexes)
+
+
+async def _v1_identifications_users(db: AsyncIOMotorDatabase) -> None:
+    collection_names = await db.list_collection_names()
+
+    if "identifications" not in collection_names:
+        await db.create_collection("identifications")
+
+    await _create_indexes(
+        db.identifications,
+        [
+            IndexModel(
+                [("namespace", ASCENDING), ("access_token", ASCENDING)], unique=True
+            ),
+            # IndexModel([("user_id", ASCENDING)]),
+            # IndexModel(
+            #     [("reference.message_id", ASCENDING)],
+            #     partialFilterExpression={"reference.message_id": {"$exists": True}},
+            # ),
+            IndexModel(
+                [("reference.user.id", ASCENDING)],
+                partialFilterExpression={"reference.user": {"$exists": True}},
+            ),
+            IndexModel(
+                [("reference.user.namespace", ASCENDING)],
+                partialFilterExpression={"reference.user": {"$exists": True}},
+            ),
+            IndexModel(
+                [("reference.message.id", ASCENDING)],
+                partialFilterExpression={"reference.message": {"$exists": True}},
+            ),
+            IndexModel(
+                [("reference.message.namespace", ASCENDING)],
+                partialFilterExpression={"reference.message": {"$exists": True}},
+            ),
+            IndexModel([("completed", ASCENDING)]),
+            IndexModel([("created", ASCENDING)]),
+            IndexModel([("status", ASCENDING)]),
+            IndexModel(
+                [
+                    (
+                        "result.classification.suggestions.details.entity_id",
+                        ASCENDING,
+                    )
+                ]
+            ),
+            IndexModel(
+                [("result.classification.suggestions.details.language", ASCENDING)]
+            ),
+            IndexModel([("result.classification.suggestions.id", ASCENDING)]),
+            IndexModel([("result.classification.suggestions.name", ASCENDING)]),
+            IndexModel([("result.classification.suggestions.probability", ASCENDING)]),
+            IndexModel([("result.is_plant.probability", ASCENDING)]),
+        ],
+    )
+
+    if "users" not in collection_names:
+        await db.create_collection("users")
+
+    await _create_indexes(
+        db.users,
+        [
+            IndexModel([("namespace", ASCENDING), ("id", ASCENDING)], unique=True),
+            IndexModel([("created_at", DESCENDING)]),
+            IndexModel([("updated_at", DESCENDING)]),
+        ],
+    )
+
+
+async def _v2_chats_albums(db: AsyncIOMotorDatabase) -> None:
+    collection_names = await db.list_collection_names()
+
+    if "chats" not in collection_names:
+        await db.create_collection("chats")
+
+    await _create_indexes(
+        db.chats,
+        [
+            IndexModel([("namespace", ASCENDING), ("id", ASCENDING)], unique=True),
+        ],
+    )
+
+    if "albums" not in collection_names:
+        await db.create_collection("albums")
+
+    await _create_indexes(
+        db.albums,
+        [
+            IndexModel([("namespace", ASCENDING), ("id", ASCENDING)], unique=True),
+            IndexModel([("created", ASCENDING)], expireAfterSeconds=ALBUM_TTL),
+        ],
+    )
+
+
+async def _v3_identifications_archive(db: AsyncIOMotorDatabase) -> None:
+    collection_names = await db.list_collection_names()
+
+    if ARCHIVE_COLLECTION not in collection_names:
+        # cold data trades some cpu on read for a much smaller footprint
+        await db.create_collection(
+            ARCHIVE_COLLECTION,
+            storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}},
+        )
+
+    await _create_indexes(
+        db[ARCHIVE_COLLECTION],
+        [
+            IndexModel(
+                [("namespace", ASCENDING), ("access_token", ASCENDING)], unique=True
+            ),
+            IndexModel(
+                [
+                    ("reference.user.id", ASCENDING),
+                    ("reference.user.namespace", ASCENDING),
+                    ("created", ASCENDING),
+                ]
+            ),
+        ],
+    )
+
+
+# append only: the position of a migration is the schema version it produces
+MIGRATIONS: List[Callable[[AsyncIOMotorDatabase], Awaitable[None]]] = [
+    _v1_identifications_users,
+    _v2_chats_albums,
+    _v3_identifications_archive,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_version(client: AsyncIOMotorClient) -> int:
+    meta = await client.get_default_database().meta.find_one(
+        {"_id": SCHEMA_ID}, projection={"version": True}
+    )
+    return meta["version"] if meta else 0
+
+
+async def migrate(client: AsyncIOMotorClient, target: int = SCHEMA_VERSION) -> int:
+    # migrations are idempotent, so two runners racing only repeat work
+    db = client.get_default_database()
+    version = await get_version(client)
+    for version in range(version + 1, target + 1):
+        logging.info(f"Applying schema migration {version}")
+        await MIGRATIONS[version - 1](db)
+        await db.meta.update_one(
+            {"_id": SCHEMA_ID},
+            {
+                # a slower runner that started earlier must not lower it
+                "$max": {"version": version},
+                "$set": {"updated_at": datetime.now().astimezone(timezone.utc)},
+            },
+            upsert=True,
+        )
+    return version
+
+
+async def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m bot.migrations", description="Apply database migrations"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only report the schema version, exit 1 if migrations are pending",
+    )
+    args = parser.parse_args(argv)
+
+    client = AsyncIOMotorClient(os.getenv("MONGODB_URL"))
+    try:
+        version = await get_version(client)
+        print(f"schema version {version}, code version {SCHEMA_VERSION}")
+        if args.check:
+            return 0 if version >= SCHEMA_VERSION else 1
+        if version < SCHEMA_VERSION:
+            print(f"migrated to {await migrate(client)}")
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -0,0 +1,231 @@
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+def _require(data: Any, key: str, kind: type | tuple) -> Any:
+    if not isinstance(data, dict) or key not in data:
+        raise ValueError(f"'{key}' is required")
+    value = data[key]
+    if not isinstance(value, kind):
+        raise ValueError(f"'{key}' has unexpected type {type(value).__name__}")
+    return value
+
+
+class _Entity:
+    __slots__ = ("namespace", "id")
+
+    def __init__(self, namespace: str, id: int) -> None:
+        self.namespace = namespace
+        self.id = id
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]):
+        return cls(
+            namespace=_require(data, "namespace", str), id=_require(data, "id", int)
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"namespace": self.namespace, "id": self.id}
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            type(other) is type(self)
+            and self.namespace == other.namespace
+            and self.id == other.id
+        )
+
+    def __hash__(self) -> int:
+        return hash((type(self), self.namespace, self.id))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.namespace!r}, {self.id!r})"
+
+
+class User(_Entity):
+    __slots__ = ()
+
+
+class Message(_Entity):
+    __slots__ = ()
+
+
+class Chat(_Entity):
+    __slots__ = ()
+
+
+class Reference:
+    __slots__ = ("user", "message", "chat", "reply")
+
+    def __init__(
+        self,
+        user: User,
+        message: Message | None = None,
+        chat: Chat | None = None,
+        reply: Message | None = None,
+    ) -> None:
+        self.user = user
+        self.message = message
+        # where the bot answered, so the answer can be updated later
+        self.chat = chat
+        self.reply = reply
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Reference":
+        def optional(key: str, kind: type) -> Any:
+            return kind.from_dict(data[key]) if data.get(key) is not None else None
+
+        return cls(
+            User.from_dict(_require(data, "user", dict)),
+            optional("message", Message),
+            chat=optional("chat", Chat),
+            reply=optional("reply", Message),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        reference = {"user": self.user.to_dict()}
+        for key in ("message", "chat", "reply"):
+            if getattr(self, key) is not None:
+                reference[key] = getattr(self, key).to_dict()
+        return reference
+
+    def __repr__(self) -> str:
+        return f"Reference({self.user!r}, {self.message!r})"
+
+
+class Suggestion:
+    """View over a raw Plant.id suggestion; fields are read on access."""
+
+    __slots__ = ("_data",)
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise ValueError("suggestion must be a dict")
+        self._data = data
+
+    @property
+    def id(self) -> str | None:
+        return self._data.get("id")
+
+    @property
+    def name(self) -> str:
+        return _require(self._data, "name", str)
+
+    @property
+    def probability(self) -> float:
+        return _require(self._data, "probability", (int, float))
+
+    @property
+    def percent(self) -> int:
+        return round(self.probability * 100)
+
+    @property
+    def approved(self) -> bool:
+        return "approved" in self._data
+
+    @property
+    def url(self) -> Dict[str, str | None]:
+        return self._data.get("details", {}).get("url") or {}
+
+    def common_names(self, languages: Iterable[str]) -> List[str]:
+        names = self._data.get("details", {}).get("common_names") or {}
+        common_names = []
+        for lang in languages:
+            if names.get(lang):
+                common_names.extend(names[lang])
+        return common_names
+
+    def __repr__(self) -> str:
+        return f"Suggestion({self._data.get('name')!r})"
+
+
+class Identification:
+    """View over a raw identification document from Mongo or Plant.id.
+
+    Nothing is parsed up front: nested parts are validated and wrapped the
+    first time they are accessed, so listing many documents costs no more
+    than the fields actually rendered.
+    """
+
+    __slots__ = ("_data", "_reference", "_suggestions")
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise ValueError("identification must be a dict")
+        self._data = data
+        self._reference = None
+        self._suggestions = None
+
+    @property
+    def raw(self) -> Dict[str, Any]:
+        return self._data
+
+    @property
+    def namespace(self) -> str:
+        return _require(self._data, "namespace", str)
+
+    @property
+    def access_token(self) -> str:
+        return _require(self._data, "access_token", str)
+
+    @property
+    def status(self) -> str | None:
+        return self._data.get("status")
+
+    @property
+    def pending(self) -> bool:
+        return self.status in ("CREATED", "IN_PROGRESS")
+
+    @property
+    def reference(self) -> Reference:
+        if self._reference is None:
+            self._reference = Reference.from_dict(
+                _require(self._data, "reference", dict)
+            )
+        return self._reference
+
+    @property
+    def _result(self) -> Dict[str, Any]:
+        return _require(self._data, "result", dict)
+
+    @property
+    def is_plant_probability(self) -> float:
+        return _require(
+            _require(self._result, "is_plant", dict), "probability", (int, float)
+        )
+
+    @property
+    def is_plant(self) -> bool:
+        is_plant = _require(self._result, "is_plant", dict)
+        return _require(is_plant, "probability", (int, float)) >= _require(
+            is_plant, "threshold", (int, float)
+        )
+
+    @property
+    def _raw_suggestions(self) -> List[Dict[str, Any]]:
+        return _require(
+            _require(self._result, "classification", dict), "suggestions", list
+        )
+
+    @property
+    def suggestions(self) -> List[Suggestion]:
+        if self._suggestions is None:
+            self._suggestions = [
+                Suggestion(suggestion) for suggestion in self._raw_suggestions
+            ]
+        return self._suggestions
+
+    @property
+    def approval(self) -> Tuple[int, ...]:
+        return tuple(
+            i for (i, suggestion) in enumerate(self.suggestions) if suggestion.approved
+        )
+
+    def suggestion(self, index: int) -> Suggestion:
+        if self._suggestions is not None:
+            return self._suggestions[index]
+        return Suggestion(self._raw_suggestions[index])
+
+    def __repr__(self) -> str:
+        return (
+            f"Identification({self._data.get('namespace')!r}, "
+            f"{self._data.get('access_token')!r})"
+        )
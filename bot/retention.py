@@ -0,0 +1,66 @@
+from typing import List
+
+import os
+import sys
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from . import db
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "180"))
+BATCH_SIZE = 500
+# pause between batches so archiving does not compete with live traffic
+BATCH_PAUSE = 1.0
+
+
+async def archive(
+    client: AsyncIOMotorClient,
+    days: int = RETENTION_DAYS,
+    batch_size: int = BATCH_SIZE,
+    pause: float = BATCH_PAUSE,
+) -> int:
+    before = datetime.now().astimezone(timezone.utc) - timedelta(days=days)
+    total = 0
+    while True:
+        moved = await db.archive_identifications(
+            client, before=before, limit=batch_size
+        )
+        total += moved
+        if moved:
+            logging.info(f"Archived {total} identifications created before {before}")
+        if moved < batch_size:
+            return total
+        await asyncio.sleep(pause)
+
+
+async def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m bot.retention",
+        description="Move old identifications into the compressed archive",
+    )
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=BATCH_PAUSE)
+    args = parser.parse_args(argv)
+
+    client = AsyncIOMotorClient(os.getenv("MONGODB_URL"))
+    try:
+        await db.init(client)
+        await archive(
+            client, days=args.days, batch_size=args.batch_size, pause=args.pause
+        )
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    sys.exit(asyncio.run(main(sys.argv[1:])))
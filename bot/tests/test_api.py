@@ -0,0 +1,120 @@
+import json
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock, ANY, patch
+from .. import api
+
+MOCK_IDENTIFICATIONS = [
+    {"namespace": "plant.id", "access_token": f"token-{i}"} for i in range(3)
+]
+MOCK_STATS = {"identifications": 3, "plants": 2, "approved": 1}
+
+
+class TestApi(unittest.IsolatedAsyncioTestCase):
+    @patch("bot.db.list_identifications", new_callable=AsyncMock)
+    async def test10_list_page(self, mock_db_list_identifications: AsyncMock) -> None:
+        mock_db_list_identifications.return_value = MOCK_IDENTIFICATIONS
+        (status, headers, body) = await api.handle_request(
+            MagicMock(), api.Cache(), b"GET", b"/users/tg/1/identifications?size=2", {}
+        )
+        self.assertEqual(status, 200)
+        mock_db_list_identifications.assert_awaited_once_with(
+            ANY,
+            user={"namespace": "tg", "id": 1},
+            projection=api.LIST_PROJECTION,
+            skip=0,
+            limit=3,
+        )
+        page = json.loads(body)
+        self.assertTrue(page["next"])
+        self.assertListEqual(page["items"], MOCK_IDENTIFICATIONS[:2])
+
+    @patch("bot.db.get_user_stats", new_callable=AsyncMock)
+    async def test20_etag_and_cache(self, mock_db_get_user_stats: AsyncMock) -> None:
+        mock_db_get_user_stats.return_value = MOCK_STATS
+        cache = api.Cache()
+        responses = await asyncio.gather(
+            *[
+                api.handle_request(MagicMock(), cache, b"GET", b"/users/tg/1/stats", {})
+                for _ in range(5)
+            ]
+        )
+        mock_db_get_user_stats.assert_awaited_once()
+        (status, headers, body) = responses[0]
+        self.assertEqual(status, 200)
+        self.assertDictEqual(json.loads(body), MOCK_STATS)
+
+        etag = dict(headers)[b"etag"]
+        (status, _, body) = await api.handle_request(
+            MagicMock(), cache, b"GET", b"/users/tg/1/stats", {b"if-none-match": etag}
+        )
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+        mock_db_get_user_stats.assert_awaited_once()
+
+    async def test30_errors(self) -> None:
+        cache = api.Cache()
+        for method, target, status in [
+            (b"POST", b"/users/tg/1/stats", 405),
+            (b"GET", b"/users/tg/x/stats", 404),
+            (b"GET", b"/users/tg/1/identifications?page=x", 400),
+        ]:
+            response = await api.handle_request(MagicMock(), cache, method, target, {})
+            self.assertEqual(response[0], status)
+
+    async def test40_failures_are_not_cached(self) -> None:
+        cache = api.Cache()
+        load = AsyncMock(side_effect=[RuntimeError, (b"{}", b'"etag"')])
+        with self.assertRaises(RuntimeError):
+            await cache.get("key", load)
+        self.assertEqual(await cache.get("key", load), (b"{}", b'"etag"'))
+
+    @patch("bot.db.get_user_stats", new_callable=AsyncMock)
+    async def test50_http(self, mock_db_get_user_stats: AsyncMock) -> None:
+        mock_db_get_user_stats.return_value = MOCK_STATS
+        cache = api.Cache()
+        server = await asyncio.start_server(
+            lambda r, w: api.serve_connection(MagicMock(), cache, r, w),
+            host="127.0.0.1",
+            port=0,
+        )
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(
+                b"GET /users/tg/1/stats HTTP/1.1\r\nHost: localhost\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+            response = await reader.read()
+            writer.close()
+        (head, body) = response.split(b"\r\n\r\n", 1)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"))
+        self.assertDictEqual(json.loads(body), MOCK_STATS)
+
+    def test60_token_required_off_loopback(self) -> None:
+        for host in ("127.0.0.1", "::1", "localhost"):
+            api.check_token(host, None)
+        api.check_token("0.0.0.0", "secret")
+        for host in ("0.0.0.0", "10.0.0.5", "portal-api"):
+            with self.assertRaises(RuntimeError):
+                api.check_token(host, None)
+
+    @patch("bot.api.API_TOKEN", new="secret")
+    async def test70_unauthorized(self) -> None:
+        for headers in ({}, {b"authorization": b"Bearer secreT"}):
+            response = await api.handle_request(
+                MagicMock(), api.Cache(), b"GET", b"/users/tg/1/stats", headers
+            )
+            self.assertEqual(response[0], 401)
+        response = await api.handle_request(
+            MagicMock(),
+            api.Cache(),
+            b"GET",
+            b"/nowhere",
+            {b"authorization": b"Bearer secret"},
+        )
+        self.assertEqual(response[0], 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
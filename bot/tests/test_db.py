@@ -0,0 +1,390 @@
+import os
+import asyncio
+import unittest
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from .. import db
+from .. import handlers
+from .. import migrations
+from .. import retention
+
+# e.g. mongodb://localhost:27017/aurea_flamma_test, the database is dropped
+MONGODB_TEST_URL = os.getenv("MONGODB_TEST_URL")
+
+PROCESSES = 4
+MOCK_ALBUM = {"namespace": "tg", "id": "album-1", "chat_id": 1, "user_id": 1}
+
+
+async def _add(instance: int) -> None:
+    client = AsyncIOMotorClient(MONGODB_TEST_URL)
+    try:
+        await db.add_album_photo(
+            client,
+            album=MOCK_ALBUM,
+            message_id=100 + instance,
+            photo={"file_id": f"{instance}"},
+            delay=0,
+        )
+    finally:
+        client.close()
+
+
+async def _claim(instance: int) -> bool:
+    client = AsyncIOMotorClient(MONGODB_TEST_URL)
+    try:
+        album = await db.claim_album(
+            client,
+            album=MOCK_ALBUM,
+            owner=f"instance-{instance}",
+            lease=60,
+            attempts=3,
+        )
+        return album is not None
+    finally:
+        client.close()
+
+
+def add(instance: int) -> None:
+    asyncio.run(_add(instance))
+
+
+def claim(instance: int) -> bool:
+    return asyncio.run(_claim(instance))
+
+
+@unittest.skipUnless(MONGODB_TEST_URL, "MONGODB_TEST_URL is not set")
+class TestDbMultiProcess(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.client = AsyncIOMotorClient(MONGODB_TEST_URL)
+        await self.client.drop_database(self.client.get_default_database())
+        await db.init(self.client)
+
+    async def asyncTearDown(self) -> None:
+        await self.client.drop_database(self.client.get_default_database())
+        self.client.close()
+
+    async def test10_album_claimed_once(self) -> None:
+        with ProcessPoolExecutor(max_workers=PROCESSES) as executor:
+            list(executor.map(add, range(PROCESSES)))
+            claimed = list(executor.map(claim, range(PROCESSES)))
+        self.assertEqual(claimed.count(True), 1)
+
+        album = await self.client.get_default_database().albums.find_one(
+            {"namespace": "tg", "id": MOCK_ALBUM["id"]}
+        )
+        self.assertEqual(len(album["photos"]), PROCESSES)
+        self.assertEqual(album["message_id"], 100)
+        self.assertEqual(album["owner"], f"instance-{claimed.index(True)}")
+
+    async def test15_album_late_photo_and_retry(self) -> None:
+        await _add(0)
+        album = await db.claim_album(
+            self.client, album=MOCK_ALBUM, owner="a", lease=60, attempts=2
+        )
+        self.assertEqual(album["attempts"], 1)
+        # a part that arrives while the album is being identified
+        await _add(1)
+        await db.delete_album(
+            self.client, album=MOCK_ALBUM, owner="a", count=len(album["photos"])
+        )
+        album = await db.claim_album(
+            self.client, album=None, owner="b", lease=60, attempts=2
+        )
+        self.assertListEqual(album["photos"], [{"file_id": "1"}])
+        self.assertEqual(album["attempts"], 1)
+
+        # a released album comes back once its new due time has passed
+        await db.release_album(self.client, album=MOCK_ALBUM, owner="b", delay=60)
+        self.assertIsNone(
+            await db.claim_album(
+                self.client, album=None, owner="c", lease=60, attempts=2
+            )
+        )
+        await self.client.get_default_database().albums.update_one(
+            {"id": MOCK_ALBUM["id"]}, {"$set": {"due": datetime(2000, 1, 1)}}
+        )
+        album = await db.claim_album(
+            self.client, album=None, owner="c", lease=60, attempts=2
+        )
+        self.assertEqual(album["attempts"], 2)
+        await db.release_album(self.client, album=MOCK_ALBUM, owner="c", delay=0)
+        # given up after the last attempt
+        self.assertIsNone(
+            await db.claim_album(
+                self.client, album=None, owner="d", lease=60, attempts=2
+            )
+        )
+
+    async def test18_failed_polls_back_off(self) -> None:
+        identifications = self.client.get_default_database().identifications
+        for i in range(3):
+            await identifications.insert_one(
+                {
+                    "namespace": "plant.id",
+                    "access_token": f"token-{i}",
+                    "status": "CREATED",
+                    "created": float(i),
+                }
+            )
+        claimed = await db.claim_pending_identifications(
+            self.client, owner="a", lease=60, limit=2
+        )
+        self.assertListEqual(
+            [doc["access_token"] for doc in claimed], ["token-0", "token-1"]
+        )
+        await db.retry_identifications(
+            self.client,
+            ["token-0", "token-1"],
+            owner="a",
+            backoff=60,
+            max_backoff=60 * 60,
+        )
+        # the failing ones wait while the newer one gets its turn
+        claimed = await db.claim_pending_identifications(
+            self.client, owner="a", lease=60, limit=2
+        )
+        self.assertListEqual([doc["access_token"] for doc in claimed], ["token-2"])
+        doc = await identifications.find_one({"access_token": "token-0"})
+        self.assertEqual(doc["poll"]["attempts"], 1)
+        self.assertNotIn("owner", doc["poll"])
+
+    async def test20_migrations(self) -> None:
+        self.assertEqual(
+            await migrations.get_version(self.client), migrations.SCHEMA_VERSION
+        )
+        self.assertEqual(
+            await migrations.migrate(self.client), migrations.SCHEMA_VERSION
+        )
+        self.assertIn(
+            "namespace_1_access_token_1",
+            await self.client.get_default_database().identifications.index_information(),
+        )
+
+    async def test30_archive_fall_through(self) -> None:
+        user = {"namespace": "tg", "id": 1}
+        for token, created in (("old", 1.0), ("new", 2.0e9)):
+            await self.client.get_default_database().identifications.insert_one(
+                {
+                    "namespace": "plant.id",
+                    "access_token": token,
+                    "status": "COMPLETED",
+                    "created": created,
+                    "reference": {"user": user},
+                }
+            )
+        self.assertEqual(await retention.archive(self.client, days=1, pause=0), 1)
+        self.assertEqual(await retention.archive(self.client, days=1, pause=0), 0)
+        self.assertIsNotNone(
+            await db.get_identification(
+                self.client, user, id={"namespace": "plant.id", "access_token": "old"}
+            )
+        )
+        self.assertListEqual(
+            [
+                doc["access_token"]
+                for doc in await db.list_identifications(self.client, user)
+            ],
+            ["old", "new"],
+        )
+        self.assertEqual(
+            (await db.get_user_stats(self.client, user))["identifications"], 2
+        )
+
+    async def test32_archive_replaces_stale_copy(self) -> None:
+        database = self.client.get_default_database()
+        identification = {
+            "namespace": "plant.id",
+            "access_token": "old",
+            "status": "COMPLETED",
+            "created": 1.0,
+            "reference": {"user": {"namespace": "tg", "id": 1}},
+        }
+        inserted = await database.identifications.insert_one(dict(identification))
+        # left by an interrupted move, before the live document was approved
+        await database[migrations.ARCHIVE_COLLECTION].insert_one(
+            {"_id": inserted.inserted_id, **identification}
+        )
+        await database.identifications.update_one(
+            {"_id": inserted.inserted_id}, {"$set": {"approved": True}}
+        )
+        self.assertEqual(await retention.archive(self.client, days=1, pause=0), 1)
+        self.assertIsNone(await database.identifications.find_one({}))
+        archived = await database[migrations.ARCHIVE_COLLECTION].find_one({})
+        self.assertTrue(archived["approved"])
+
+    async def test35_order_without_created_in_projection(self) -> None:
+        user = {"namespace": "tg", "id": 1}
+        database = self.client.get_default_database()
+        # inserted newest first, the oldest ones already archived
+        for i in reversed(range(6)):
+            collection = (
+                database[migrations.ARCHIVE_COLLECTION]
+                if i < 3
+                else database.identifications
+            )
+            await collection.insert_one(
+                {
+                    "namespace": "plant.id",
+                    "access_token": f"token-{i}",
+                    "created": float(i),
+                    "reference": {"user": user},
+                }
+            )
+        projection = {"_id": False, "access_token": True}
+        pages = [
+            await db.list_identifications(
+                self.client, user, projection=projection, skip=skip, limit=2
+            )
+            for skip in (0, 2, 4)
+        ]
+        self.assertListEqual(
+            [doc for page in pages for doc in page],
+            [{"access_token": f"token-{i}"} for i in range(6)],
+        )
+        self.assertListEqual(
+            [
+                doc
+                async for doc in db.iter_identifications(
+                    self.client, user, projection=projection, batch_size=2
+                )
+            ],
+            [{"access_token": f"token-{i}"} for i in range(6)],
+        )
+
+    async def test37_list_pages_in_order(self) -> None:
+        user = {"namespace": "tg", "id": 1}
+        database = self.client.get_default_database()
+        count = handlers.LIST_PAGE_SIZE * 2 + 3
+        for i in reversed(range(count)):
+            collection = (
+                database[migrations.ARCHIVE_COLLECTION]
+                if i < handlers.LIST_PAGE_SIZE
+                else database.identifications
+            )
+            await collection.insert_one(
+                {
+                    "namespace": "plant.id",
+                    "access_token": f"token-{i:03}",
+                    "status": "COMPLETED",
+                    "created": float(i),
+                    "reference": {"user": user},
+                    "result": {"is_plant": {"probability": 0.9, "threshold": 0.5}},
+                }
+            )
+        tokens = []
+        for page in range(3):
+            tokens.extend(
+                doc["access_token"]
+                for doc in await db.list_identifications(
+                    self.client,
+                    user,
+                    projection=handlers.LIST_PROJECTION,
+                    skip=page * handlers.LIST_PAGE_SIZE,
+                    limit=handlers.LIST_PAGE_SIZE,
+                    filter=handlers.LIST_FILTER,
+                )
+            )
+        self.assertListEqual(tokens, [f"token-{i:03}" for i in range(count)])
+
+    async def test40_chat_location(self) -> None:
+        chat = {"namespace": "tg", "id": 1}
+        self.assertIsNone(await db.get_chat_location(self.client, chat))
+        await db.set_chat_location(
+            self.client, chat, location={"latitude": 1.0, "longitude": 2.0}
+        )
+        self.assertDictEqual(
+            await db.get_chat_location(self.client, chat),
+            {"latitude": 1.0, "longitude": 2.0},
+        )
+
+
+class TestInit(unittest.IsolatedAsyncioTestCase):
+    @patch("bot.migrations.migrate", new_callable=AsyncMock)
+    @patch("bot.migrations.get_version", new_callable=AsyncMock)
+    async def test10_init_up_to_date(
+        self, mock_get_version: AsyncMock, mock_migrate: AsyncMock
+    ) -> None:
+        mock_get_version.return_value = migrations.SCHEMA_VERSION
+        await db.init(MagicMock())
+        mock_get_version.assert_awaited_once()
+        mock_migrate.assert_not_awaited()
+
+    @patch("bot.migrations.migrate", new_callable=AsyncMock)
+    @patch("bot.migrations.get_version", new_callable=AsyncMock)
+    async def test20_init_outdated(
+        self, mock_get_version: AsyncMock, mock_migrate: AsyncMock
+    ) -> None:
+        mock_get_version.return_value = migrations.SCHEMA_VERSION - 1
+        client = MagicMock()
+        await db.init(client)
+        mock_migrate.assert_awaited_once_with(client)
+
+    @patch("bot.migrations.MIGRATIONS", new=[AsyncMock(), AsyncMock()])
+    @patch("bot.migrations.get_version", new_callable=AsyncMock)
+    async def test30_migrate_never_lowers_version(
+        self, mock_get_version: AsyncMock
+    ) -> None:
+        mock_get_version.return_value = 0
+        client = MagicMock()
+        update_one = client.get_default_database.return_value.meta.update_one
+        update_one.side_effect = AsyncMock()
+        self.assertEqual(await migrations.migrate(client, target=2), 2)
+        self.assertListEqual(
+            [call.args[1]["$max"] for call in update_one.call_args_list],
+            [{"version": 1}, {"version": 2}],
+        )
+        for call in update_one.call_args_list:
+            self.assertNotIn("version", call.args[1]["$set"])
+
+
+class TestPipeline(unittest.TestCase):
+    def test10_projection_before_union(self) -> None:
+        pipeline = db._user_identifications(
+            {"namespace": "tg", "id": 1},
+            projection={"_id": False, "access_token": True},
+            skip=20,
+            limit=10,
+        )
+        self.assertListEqual(
+            [next(iter(stage)) for stage in pipeline],
+            ["$match", "$project", "$unionWith", "$sort", "$skip", "$limit", "$unset"],
+        )
+        branch = pipeline[2]["$unionWith"]["pipeline"]
+        self.assertListEqual(branch, pipeline[:2])
+        self.assertDictEqual(
+            branch[1]["$project"],
+            {"_id": False, "access_token": True, "created": True},
+        )
+        self.assertListEqual(pipeline[-1]["$unset"], ["created"])
+
+    def test20_sort_keys_kept(self) -> None:
+        user = {"namespace": "tg", "id": 1}
+        pipeline = db._user_identifications(user, projection=None)
+        self.assertDictEqual(pipeline[1]["$project"], {"_id": False})
+        self.assertEqual(next(iter(pipeline[-1])), "$sort")
+
+        pipeline = db._user_identifications(
+            user, projection={"_id": False, "created": False, "result": False}
+        )
+        self.assertDictEqual(pipeline[1]["$project"], {"_id": False, "result": False})
+        self.assertListEqual(pipeline[-1]["$unset"], ["created"])
+
+
+class TestRetention(unittest.IsolatedAsyncioTestCase):
+    @patch("asyncio.sleep", new_callable=AsyncMock)
+    @patch("bot.db.archive_identifications", new_callable=AsyncMock)
+    async def test10_batches(
+        self, mock_db_archive_identifications: AsyncMock, mock_sleep: AsyncMock
+    ) -> None:
+        mock_db_archive_identifications.side_effect = [2, 2, 1]
+        self.assertEqual(await retention.archive(MagicMock(), batch_size=2), 5)
+        self.assertEqual(mock_db_archive_identifications.await_count, 3)
+        self.assertEqual(mock_sleep.await_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import csv
+import gzip
+import json
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+from .. import export
+
+MOCK_IDENTIFICATIONS = [
+    {
+        "namespace": "plant.id",
+        "access_token": f"token-{i}",
+        "status": "COMPLETED",
+        "created": 1687433322.887879,
+        "input": {"latitude": 49.207, "longitude": 16.608},
+        "result": {
+            "is_plant": {"probability": 0.9},
+            "classification": {
+                "suggestions": [
+                    {"name": "Leucojum vernum", "probability": 0.8},
+                    {"name": "Galanthus nivalis", "probability": 0.1, "approved": {}},
+                ]
+            },
+        },
+    }
+    for i in range(5)
+]
+
+
+async def mock_iter_identifications(client, user, projection, batch_size):
+    for identification in MOCK_IDENTIFICATIONS:
+        yield identification
+
+
+class TestExport(unittest.IsolatedAsyncioTestCase):
+    @patch("bot.db.iter_identifications", new=mock_iter_identifications)
+    async def test10_ndjson(self) -> None:
+        (path, count) = await export.export_identifications(
+            MagicMock(), user={"namespace": "tg", "id": 1}, batch_size=2
+        )
+        try:
+            self.assertEqual(count, len(MOCK_IDENTIFICATIONS))
+            with gzip.open(path, "rt", encoding="utf-8") as file:
+                rows = [json.loads(line) for line in file]
+        finally:
+            os.remove(path)
+        self.assertEqual([row["access_token"] for row in rows][-1], "token-4")
+        self.assertEqual(rows[0]["name"], "Leucojum vernum")
+        self.assertEqual(rows[0]["approved"], "Galanthus nivalis")
+        self.assertEqual(rows[0]["created"], "2023-06-22T11:28:42.887879+00:00")
+
+    @patch("bot.db.iter_identifications", new=mock_iter_identifications)
+    async def test20_csv(self) -> None:
+        (path, count) = await export.export_identifications(
+            MagicMock(), user={"namespace": "tg", "id": 1}, format="csv"
+        )
+        try:
+            with gzip.open(path, "rt", encoding="utf-8", newline="") as file:
+                rows = list(csv.DictReader(file))
+        finally:
+            os.remove(path)
+        self.assertEqual(len(rows), count)
+        self.assertListEqual(list(rows[0].keys()), export.EXPORT_FIELDS)
+
+    async def test30_unknown_format(self) -> None:
+        with self.assertRaises(ValueError):
+            await export.export_identifications(
+                MagicMock(), user={"namespace": "tg", "id": 1}, format="xml"
+            )
+
+    @patch("tempfile.NamedTemporaryFile")
+    async def test40_failure_removes_file(self, mock_temporary_file) -> None:
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "x.gz")
+        mock_temporary_file.return_value.__enter__.return_value.name = path
+
+        async def failing_iter_identifications(client, user, projection, batch_size):
+            yield MOCK_IDENTIFICATIONS[0]
+            raise RuntimeError("cursor died")
+
+        with patch("bot.db.iter_identifications", new=failing_iter_identifications):
+            with self.assertRaises(RuntimeError):
+                await export.export_identifications(
+                    MagicMock(), user={"namespace": "tg", "id": 1}
+                )
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
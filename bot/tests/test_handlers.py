@@ -2,6 +2,7 @@ import unittest
 from unittest.mock import AsyncMock, MagicMock, ANY, patch
 from .. import handlers
 from pprint import pprint
+from copy import deepcopy
 
 from telegram import Location, PhotoSize
 
@@ -62,6 +63,33 @@ MOCK_PLANT_ID = {
     },
 }
 
+MOCK_REPLY_ID = 2
+MOCK_PENDING_PLANT_ID = {
+    "namespace": "plant.id",
+    "access_token": "GxRxExAxTxSxHxIxT",
+    "status": "CREATED",
+}
+MOCK_PENDING_REFERENCE = {
+    "user": {"namespace": "tg", "id": MOCK_USER_ID},
+    "message": {"namespace": "tg", "id": MOCK_MESSAGE_ID},
+    "chat": {"namespace": "tg", "id": MOCK_CHAT_ID},
+    "reply": {"namespace": "tg", "id": MOCK_REPLY_ID},
+}
+
+MOCK_LIST_PLANT_ID = {
+    "namespace": "plant.id",
+    "access_token": "GxRxExAxTxSxHxIxT",
+    "status": "COMPLETED",
+    "result": {
+        "is_plant": {"probability": 0.9, "threshold": 0.5},
+        "classification": {
+            "suggestions": [
+                {"id": "s1", "probability": 0.8, "name": "Squamosus Ridiculus"}
+            ]
+        },
+    },
+}
+
 
 async def mock_get_file(file_id: str) -> bytearray:
     mock = AsyncMock()
@@ -70,9 +98,6 @@ async def mock_get_file(file_id: str) -> bytearray:
 
 
 class TestHandlers(unittest.IsolatedAsyncioTestCase):
-    def setUp(self) -> None:
-        handlers.chat_locations.clear()
-
     @patch("telegram.Update", new_callable=AsyncMock)
     @patch("telegram.ext.CallbackContext", new_callable=AsyncMock)
     async def test10_start(
@@ -85,21 +110,35 @@ class TestHandlers(unittest.IsolatedAsyncioTestCase):
             text=ANY, parse_mode=ANY, reply_markup=ANY
         )
 
+    @patch("bot.db.set_chat_location", new_callable=AsyncMock)
     @patch("telegram.Update", new_callable=AsyncMock)
     @patch("telegram.ext.CallbackContext", new_callable=AsyncMock)
     async def test20_location(
-        self, mock_context: AsyncMock, mock_update: AsyncMock
+        self,
+        mock_context: AsyncMock,
+        mock_update: AsyncMock,
+        mock_db_set_chat_location: AsyncMock,
     ) -> None:
         mock_update.message.location = Location(1.0, 1.0)
         mock_update.effective_chat.id = 1
+        mock_context.bot_data = {"db_client": MagicMock()}
         await handlers.location(mock_update, mock_context)
-        self.assertDictEqual(handlers.chat_locations, {1: Location(1.0, 1.0)})
+        mock_db_set_chat_location.assert_awaited_once_with(
+            ANY,
+            chat={"namespace": "tg", "id": 1},
+            location={"latitude": 1.0, "longitude": 1.0},
+        )
 
+    @patch("bot.db.add_album_photo", new_callable=AsyncMock)
     @patch("telegram.Update", new_callable=AsyncMock)
     @patch("telegram.ext.CallbackContext", new_callable=AsyncMock)
     async def test30_photo(
-        self, mock_context: AsyncMock, mock_update: AsyncMock
+        self,
+        mock_context: AsyncMock,
+        mock_update: AsyncMock,
+        mock_db_add_album_photo: AsyncMock,
     ) -> None:
+        mock_context.bot_data = {"db_client": MagicMock()}
         mock_update.message.location = Location(1.0, 1.0)
         mock_update.effective_chat.id = MOCK_CHAT_ID
         mock_update.effective_user.id = MOCK_USER_ID
@@ -138,14 +177,40 @@ class TestHandlers(unittest.IsolatedAsyncioTestCase):
             user_id=mock_update.effective_user.id,
         )
         job_callback = mock_context.job_queue.run_once.call_args.args[0]
+        self.assertEqual(mock_db_add_album_photo.await_count, 2)
+        self.assertEqual(
+            mock_db_add_album_photo.call_args.kwargs["message_id"],
+            MOCK_MESSAGE_ID + 1,
+        )
+        self.assertEqual(
+            mock_db_add_album_photo.call_args.kwargs["photo"],
+            MOCK_PHOTOS[1][-1].to_dict(),
+        )
 
+    @patch("bot.db.delete_album", new_callable=AsyncMock)
+    @patch("bot.db.get_chat_location", new_callable=AsyncMock)
+    @patch("bot.db.claim_album", new_callable=AsyncMock)
     @patch("bot.handlers.identify_photos", new_callable=AsyncMock)
-    async def test40_batch_group_job(self, mock_identify_photos: AsyncMock) -> None:
+    async def test40_batch_group_job(
+        self,
+        mock_identify_photos: AsyncMock,
+        mock_db_claim_album: AsyncMock,
+        mock_db_get_chat_location: AsyncMock,
+        mock_db_delete_album: AsyncMock,
+    ) -> None:
         mock_context = MagicMock()
-        mock_context.job.user_id = MOCK_USER_ID
-        mock_context.job.chat_id = MOCK_CHAT_ID
         mock_context.job.data = MOCK_MEDIA_GROUP_ID
         mock_context.bot.send_message = AsyncMock()
+        mock_context.bot_data = {"db_client": MagicMock()}
+        mock_db_claim_album.return_value = {
+            "namespace": "tg",
+            "id": MOCK_MEDIA_GROUP_ID,
+            "chat_id": MOCK_CHAT_ID,
+            "user_id": MOCK_USER_ID,
+            "message_id": MOCK_MESSAGE_ID,
+            "photos": [photo[-1].to_dict() for photo in MOCK_PHOTOS],
+        }
+        mock_db_get_chat_location.return_value = {"latitude": 1.0, "longitude": 1.0}
         mock_identify_photos.return_value = MOCK_PLANT_ID
         await handlers.batch_group_job(mock_context)
         mock_identify_photos.assert_called_once_with(
@@ -153,8 +218,74 @@ class TestHandlers(unittest.IsolatedAsyncioTestCase):
             user_id=MOCK_USER_ID,
             chat_id=MOCK_CHAT_ID,
             message_id=MOCK_MESSAGE_ID,
-            photos=ANY,
-            location=ANY,
+            photos=[(photo[-1],) for photo in MOCK_PHOTOS],
+            location=Location(1.0, 1.0),
+        )
+        mock_db_delete_album.assert_awaited_once_with(
+            ANY,
+            album={"namespace": "tg", "id": MOCK_MEDIA_GROUP_ID},
+            owner=ANY,
+            count=len(MOCK_PHOTOS),
+        )
+
+        mock_identify_photos.reset_mock()
+        mock_db_claim_album.return_value = None
+        await handlers.batch_group_job(mock_context)
+        mock_identify_photos.assert_not_called()
+
+    @patch("bot.db.delete_album", new_callable=AsyncMock)
+    @patch("bot.db.release_album", new_callable=AsyncMock)
+    @patch("bot.db.get_chat_location", new_callable=AsyncMock)
+    @patch("bot.db.claim_album", new_callable=AsyncMock)
+    @patch("bot.handlers.identify_photos", new_callable=AsyncMock)
+    async def test45_sweep_failed_album(
+        self,
+        mock_identify_photos: AsyncMock,
+        mock_db_claim_album: AsyncMock,
+        mock_db_get_chat_location: AsyncMock,
+        mock_db_release_album: AsyncMock,
+        mock_db_delete_album: AsyncMock,
+    ) -> None:
+        mock_context = MagicMock()
+        mock_context.bot.send_message = AsyncMock()
+        mock_context.bot_data = {"db_client": MagicMock()}
+        album = {
+            "namespace": "tg",
+            "id": MOCK_MEDIA_GROUP_ID,
+            "chat_id": MOCK_CHAT_ID,
+            "user_id": MOCK_USER_ID,
+            "message_id": MOCK_MESSAGE_ID,
+            "photos": [MOCK_PHOTOS[0][-1].to_dict()],
+        }
+        mock_db_claim_album.side_effect = [
+            {**album, "attempts": 1},
+            {**album, "attempts": handlers.ALBUM_ATTEMPTS},
+            None,
+        ]
+        mock_db_get_chat_location.return_value = None
+        mock_identify_photos.side_effect = RuntimeError("plant.id is down")
+
+        await handlers.sweep_albums(mock_context)
+
+        self.assertIsNone(mock_db_claim_album.call_args.kwargs["album"])
+        self.assertEqual(mock_identify_photos.await_count, 2)
+        # released for another attempt first, then given up on
+        mock_db_release_album.assert_awaited_once_with(
+            ANY,
+            album={"namespace": "tg", "id": MOCK_MEDIA_GROUP_ID},
+            owner=handlers.INSTANCE_ID,
+            delay=handlers.ALBUM_SWEEP_INTERVAL,
+        )
+        mock_context.bot.send_message.assert_awaited_once_with(
+            chat_id=MOCK_CHAT_ID,
+            text="Sorry, the identification failed.",
+            reply_to_message_id=MOCK_MESSAGE_ID,
+        )
+        mock_db_delete_album.assert_awaited_once_with(
+            ANY,
+            album={"namespace": "tg", "id": MOCK_MEDIA_GROUP_ID},
+            owner=handlers.INSTANCE_ID,
+            count=1,
         )
 
     @patch("bot.handlers.create_identification", new_callable=AsyncMock)
@@ -182,7 +313,7 @@ class TestHandlers(unittest.IsolatedAsyncioTestCase):
         )
 
         mock_create_identification.assert_called_once_with(
-            images=ANY, location=(1.0, 1.0)
+            images=ANY, location=(1.0, 1.0), asynchronous=False
         )
         mock_db_add_identification.assert_called_once_with(
             client=ANY,
@@ -203,6 +334,260 @@ class TestHandlers(unittest.IsolatedAsyncioTestCase):
             reply_to_message_id=ANY,
         )
 
+    @patch("bot.handlers.PLANT_ID_ASYNC", new=True)
+    @patch("bot.handlers.create_identification", new_callable=AsyncMock)
+    @patch("bot.db.add_identification", new_callable=AsyncMock)
+    async def test60_identify_photos_async(
+        self,
+        mock_db_add_identification: AsyncMock,
+        mock_create_identification: AsyncMock,
+    ):
+        mock_create_identification.return_value = MOCK_PENDING_PLANT_ID
+        mock_context = MagicMock()
+        mock_context.bot.send_message = AsyncMock(
+            return_value=MagicMock(message_id=MOCK_REPLY_ID)
+        )
+        mock_context.bot.get_file = mock_get_file
+        mock_context.bot_data = {"db_client": MagicMock()}
+
+        await handlers.identify_photos(
+            mock_context,
+            user_id=MOCK_USER_ID,
+            chat_id=MOCK_CHAT_ID,
+            message_id=MOCK_MESSAGE_ID,
+            photos=MOCK_PHOTOS,
+        )
+
+        mock_create_identification.assert_called_once_with(
+            images=ANY, location=None, asynchronous=True
+        )
+        mock_context.bot.send_message.assert_awaited_once_with(
+            chat_id=MOCK_CHAT_ID, text=ANY, reply_to_message_id=MOCK_MESSAGE_ID
+        )
+        mock_db_add_identification.assert_called_once_with(
+            client=ANY,
+            user={"namespace": "tg", "id": MOCK_USER_ID},
+            identification={
+                "reference": MOCK_PENDING_REFERENCE,
+                **MOCK_PENDING_PLANT_ID,
+            },
+        )
+
+    @patch("bot.db.release_identifications", new_callable=AsyncMock)
+    @patch("bot.db.complete_identification", new_callable=AsyncMock)
+    @patch("bot.db.claim_pending_identifications", new_callable=AsyncMock)
+    @patch("bot.handlers.retrieve_identifications", new_callable=AsyncMock)
+    async def test70_poll_identifications(
+        self,
+        mock_retrieve_identifications: AsyncMock,
+        mock_db_claim_pending_identifications: AsyncMock,
+        mock_db_complete_identification: AsyncMock,
+        mock_db_release_identifications: AsyncMock,
+    ):
+        still_pending = {**MOCK_PENDING_PLANT_ID, "access_token": "StIlLpEnDiNg"}
+        completed = {**MOCK_PLANT_ID, "status": "COMPLETED"}
+        mock_db_claim_pending_identifications.return_value = [
+            {"reference": MOCK_PENDING_REFERENCE, **MOCK_PENDING_PLANT_ID},
+            {"reference": MOCK_PENDING_REFERENCE, **still_pending},
+        ]
+        mock_retrieve_identifications.return_value = [completed, still_pending]
+        mock_db_complete_identification.return_value = {
+            "reference": MOCK_PENDING_REFERENCE,
+            **completed,
+        }
+        mock_context = MagicMock()
+        mock_context.bot.edit_message_text = AsyncMock()
+        mock_context.bot_data = {"db_client": MagicMock()}
+
+        await handlers.poll_identifications(mock_context)
+
+        mock_retrieve_identifications.assert_awaited_once_with(
+            [MOCK_PLANT_ID["access_token"], "StIlLpEnDiNg"]
+        )
+        mock_db_complete_identification.assert_awaited_once_with(
+            ANY, id=completed, identification=completed
+        )
+        mock_context.bot.edit_message_text.assert_awaited_once_with(
+            chat_id=MOCK_CHAT_ID,
+            message_id=MOCK_REPLY_ID,
+            text=ANY,
+            reply_markup=ANY,
+        )
+        mock_db_release_identifications.assert_awaited_once_with(
+            ANY, ["StIlLpEnDiNg"], owner=handlers.INSTANCE_ID
+        )
+
+    @patch("bot.db.retry_identifications", new_callable=AsyncMock)
+    @patch("bot.db.release_identifications", new_callable=AsyncMock)
+    @patch("bot.db.complete_identification", new_callable=AsyncMock)
+    @patch("bot.db.claim_pending_identifications", new_callable=AsyncMock)
+    @patch("bot.handlers.retrieve_identifications", new_callable=AsyncMock)
+    async def test75_poll_retrievals_fail(
+        self,
+        mock_retrieve_identifications: AsyncMock,
+        mock_db_claim_pending_identifications: AsyncMock,
+        mock_db_complete_identification: AsyncMock,
+        mock_db_release_identifications: AsyncMock,
+        mock_db_retry_identifications: AsyncMock,
+    ):
+        fresh = {**MOCK_PENDING_PLANT_ID, "access_token": "FrEsH"}
+        exhausted = {
+            **MOCK_PENDING_PLANT_ID,
+            "access_token": "ExHaUsTeD",
+            "poll": {"attempts": handlers.POLL_ATTEMPTS - 1},
+        }
+        expired = {
+            **MOCK_PENDING_PLANT_ID,
+            "access_token": "ExPiReD",
+            "created": 1687433322.887879,
+        }
+        mock_db_claim_pending_identifications.return_value = [
+            {"reference": MOCK_PENDING_REFERENCE, **doc}
+            for doc in (fresh, exhausted, expired)
+        ]
+        mock_retrieve_identifications.return_value = [None, None, None]
+        mock_db_complete_identification.side_effect = (
+            lambda client, id, identification: {
+                "reference": MOCK_PENDING_REFERENCE,
+                **identification,
+            }
+        )
+        mock_context = MagicMock()
+        mock_context.bot.edit_message_text = AsyncMock()
+        mock_context.bot_data = {"db_client": MagicMock()}
+
+        await handlers.poll_identifications(mock_context)
+
+        mock_db_retry_identifications.assert_awaited_once_with(
+            ANY,
+            ["FrEsH"],
+            owner=handlers.INSTANCE_ID,
+            backoff=handlers.POLL_BACKOFF,
+            max_backoff=handlers.POLL_MAX_BACKOFF,
+        )
+        mock_db_release_identifications.assert_not_awaited()
+        self.assertListEqual(
+            [
+                (
+                    call.kwargs["id"]["access_token"],
+                    call.kwargs["identification"]["status"],
+                )
+                for call in mock_db_complete_identification.await_args_list
+            ],
+            [("ExHaUsTeD", "FAILED"), ("ExPiReD", "FAILED")],
+        )
+        self.assertEqual(mock_context.bot.edit_message_text.await_count, 2)
+        self.assertEqual(
+            mock_context.bot.edit_message_text.call_args.kwargs["text"],
+            "Sorry, the identification failed.",
+        )
+
+    @patch("bot.db.list_identifications", new_callable=AsyncMock)
+    async def test80_list(self, mock_db_list_identifications: AsyncMock) -> None:
+        mock_db_list_identifications.return_value = [
+            {**MOCK_LIST_PLANT_ID, "access_token": f"token-{i}"}
+            for i in range(handlers.LIST_PAGE_SIZE + 1)
+        ]
+        mock_update = MagicMock()
+        mock_update.message.from_user.id = MOCK_USER_ID
+        mock_update.effective_chat.id = MOCK_CHAT_ID
+        mock_context = MagicMock()
+        mock_context.bot.send_message = AsyncMock()
+        mock_context.bot_data = {"db_client": MagicMock()}
+
+        await handlers.list(mock_update, mock_context)
+
+        mock_db_list_identifications.assert_awaited_once_with(
+            ANY,
+            user={"namespace": "tg", "id": MOCK_USER_ID},
+            projection=handlers.LIST_PROJECTION,
+            skip=0,
+            limit=handlers.LIST_PAGE_SIZE + 1,
+            filter=handlers.LIST_FILTER,
+        )
+        mock_context.bot.send_message.assert_awaited_once()
+        kwargs = mock_context.bot.send_message.call_args.kwargs
+        self.assertEqual(len(kwargs["text"].splitlines()), handlers.LIST_PAGE_SIZE)
+        keyboard = kwargs["reply_markup"].inline_keyboard
+        self.assertEqual(keyboard[0][0].callback_data, "p:token-0:back:0")
+        self.assertListEqual([button.callback_data for button in keyboard[-1]], ["l:1"])
+        for row in keyboard:
+            for button in row:
+                self.assertLessEqual(len(button.callback_data.encode()), 64)
+
+    @patch("bot.db.list_identifications", new_callable=AsyncMock)
+    async def test85_list_next_page(
+        self, mock_db_list_identifications: AsyncMock
+    ) -> None:
+        mock_db_list_identifications.return_value = [
+            {**MOCK_LIST_PLANT_ID, "access_token": f"token-{i}"} for i in range(3)
+        ]
+        mock_update = MagicMock()
+        mock_update.effective_user.id = MOCK_USER_ID
+        mock_update.callback_query.data = "l:1"
+        mock_update.callback_query.answer = AsyncMock()
+        mock_update.callback_query.edit_message_text = AsyncMock()
+        mock_context = MagicMock()
+        mock_context.bot_data = {"db_client": MagicMock()}
+
+        await handlers.button(mock_update, mock_context)
+
+        mock_db_list_identifications.assert_awaited_once_with(
+            ANY,
+            user={"namespace": "tg", "id": MOCK_USER_ID},
+            projection=handlers.LIST_PROJECTION,
+            skip=handlers.LIST_PAGE_SIZE,
+            limit=handlers.LIST_PAGE_SIZE + 1,
+            filter=handlers.LIST_FILTER,
+        )
+        kwargs = mock_update.callback_query.edit_message_text.call_args.kwargs
+        first = handlers.LIST_PAGE_SIZE + 1
+        self.assertListEqual(
+            [line.split(".")[0] for line in kwargs["text"].splitlines()],
+            [f"{n}" for n in range(first, first + 3)],
+        )
+        keyboard = kwargs["reply_markup"].inline_keyboard
+        self.assertEqual(keyboard[0][0].callback_data, "p:token-0:back:1")
+        self.assertListEqual([button.callback_data for button in keyboard[-1]], ["l:0"])
+
+    @patch("bot.db.get_identification", new_callable=AsyncMock)
+    async def test90_button(self, mock_db_get_identification: AsyncMock) -> None:
+        mock_db_get_identification.return_value = MOCK_LIST_PLANT_ID
+        mock_update = MagicMock()
+        mock_update.effective_user.id = MOCK_USER_ID
+        mock_update.callback_query.answer = AsyncMock()
+        mock_update.callback_query.edit_message_text = AsyncMock()
+        mock_context = MagicMock()
+        mock_context.bot_data = {"db_client": MagicMock()}
+
+        for data in ("p:GxRxExAxTxSxHxIxT:back:2", "plant.id:GxRxExAxTxSxHxIxT:back"):
+            mock_update.callback_query.data = data
+            await handlers.button(mock_update, mock_context)
+            mock_db_get_identification.assert_awaited_with(
+                ANY,
+                user={"namespace": "tg", "id": MOCK_USER_ID},
+                id={"namespace": "plant.id", "access_token": "GxRxExAxTxSxHxIxT"},
+            )
+        calls = mock_update.callback_query.edit_message_text.call_args_list
+        with_page = calls[0].kwargs["reply_markup"].inline_keyboard
+        self.assertEqual(with_page[0][0].callback_data, "p:GxRxExAxTxSxHxIxT:@0:2")
+        self.assertEqual(with_page[-1][0].callback_data, "l:2")
+        without_page = calls[1].kwargs["reply_markup"].inline_keyboard
+        self.assertEqual(len(without_page), 1)
+
+    def test100_render_cache(self) -> None:
+        identification = handlers.models.Identification(MOCK_LIST_PLANT_ID)
+        self.assertIs(
+            handlers.create_message(identification),
+            handlers.create_message(handlers.models.Identification(MOCK_LIST_PLANT_ID)),
+        )
+        approved = deepcopy(MOCK_LIST_PLANT_ID)
+        approved["result"]["classification"]["suggestions"][0]["approved"] = {}
+        text, keyboard = handlers.create_message(
+            handlers.models.Identification(approved)
+        )
+        self.assertTrue(keyboard[0][0].text.endswith("\u2705"))
+
 
 if __name__ == "__main__":
     unittest.main()
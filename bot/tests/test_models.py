@@ -0,0 +1,67 @@
+import unittest
+from .. import models
+
+MOCK_IDENTIFICATION = {
+    "namespace": "plant.id",
+    "access_token": "GxRxExAxTxSxHxIxT",
+    "reference": {
+        "user": {"namespace": "tg", "id": 1},
+        "message": {"namespace": "tg", "id": 2},
+    },
+    "result": {
+        "is_plant": {"probability": 0.9, "threshold": 0.5},
+        "classification": {
+            "suggestions": [
+                {
+                    "id": "s1",
+                    "probability": 0.8,
+                    "name": "Squamosus Ridiculus",
+                    "approved": {},
+                    "details": {
+                        "url": {"global": "https://www.gbif.org/species/000000"},
+                        "common_names": {"en": ["Scaly"], "ru": None, "ua": ["Луска"]},
+                    },
+                },
+                {"id": "s2", "probability": 0.1, "name": 42},
+            ]
+        },
+    },
+}
+
+
+class TestModels(unittest.TestCase):
+    def test10_reference_round_trip(self) -> None:
+        reference = models.Reference.from_dict(MOCK_IDENTIFICATION["reference"])
+        self.assertEqual(reference.user, models.User("tg", 1))
+        self.assertEqual(reference.message, models.Message("tg", 2))
+        self.assertNotEqual(reference.user, models.Message("tg", 1))
+        self.assertDictEqual(reference.to_dict(), MOCK_IDENTIFICATION["reference"])
+        with self.assertRaises(ValueError):
+            models.User.from_dict({"namespace": "tg"})
+
+    def test20_identification(self) -> None:
+        identification = models.Identification(MOCK_IDENTIFICATION)
+        self.assertEqual(identification.access_token, "GxRxExAxTxSxHxIxT")
+        self.assertTrue(identification.is_plant)
+        self.assertEqual(identification.reference.message.id, 2)
+        suggestion = identification.suggestion(0)
+        self.assertEqual(suggestion.percent, 80)
+        self.assertTrue(suggestion.approved)
+        self.assertListEqual(
+            suggestion.common_names(["ua", "ru", "en"]), ["Луска", "Scaly"]
+        )
+        self.assertEqual(len(identification.suggestions), 2)
+
+    def test30_lazy_validation(self) -> None:
+        identification = models.Identification({"namespace": "plant.id"})
+        self.assertEqual(identification.namespace, "plant.id")
+        with self.assertRaises(ValueError):
+            identification.access_token
+        suggestion = models.Identification(MOCK_IDENTIFICATION).suggestion(1)
+        self.assertFalse(suggestion.approved)
+        with self.assertRaises(ValueError):
+            suggestion.name
+
+
+if __name__ == "__main__":
+    unittest.main()